@@ -0,0 +1,78 @@
+# Compares benchmark results of two configurations
+#
+# Usage: python benchmark/compare.py <baseline result> <candidate result> [--json]
+# -------------------------------------------------
+import argparse
+import json
+
+METRICS = ["throughput_per_sec", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "errors"]
+
+
+def get_delta(baseline, candidate):
+    if baseline is None or candidate is None:
+        return None
+
+    return {"baseline": baseline,
+            "candidate": candidate,
+            "change_pct": (candidate - baseline) / baseline * 100 if baseline else None}
+
+
+def compare(baseline, candidate):
+    comparison = {"operations": {}, "containers": {}}
+
+    for operation in sorted(set(baseline["operations"]) | set(candidate["operations"])):
+        comparison["operations"][operation] = {
+            metric: get_delta(baseline["operations"].get(operation, {}).get(metric),
+                              candidate["operations"].get(operation, {}).get(metric))
+            for metric in METRICS
+        }
+
+    comparison["overall"] = {metric: get_delta(baseline["overall"][metric], candidate["overall"][metric])
+                             for metric in METRICS}
+    comparison["cache_hit_ratio"] = get_delta((baseline["cache"] or {}).get("hit_ratio"),
+                                              (candidate["cache"] or {}).get("hit_ratio"))
+
+    for container in sorted(set(baseline["containers"]) & set(candidate["containers"])):
+        comparison["containers"][container] = get_delta(baseline["containers"][container]["rss_max_bytes"],
+                                                        candidate["containers"][container]["rss_max_bytes"])
+
+    return comparison
+
+
+def print_table(comparison):
+    rows = [(operation, metric, delta) for operation, metrics in sorted(comparison["operations"].items())
+            for metric, delta in metrics.items()]
+    rows += [("overall", metric, delta) for metric, delta in comparison["overall"].items()]
+    rows += [("cache", "hit_ratio", comparison["cache_hit_ratio"])]
+    rows += [(container, "rss_max_bytes", delta) for container, delta in comparison["containers"].items()]
+
+    print("{:<32} {:<20} {:>14} {:>14} {:>10}".format("scope", "metric", "baseline", "candidate", "change"))
+
+    for scope, metric, delta in rows:
+        if delta is None:
+            continue
+
+        print("{:<32} {:<20} {:>14.2f} {:>14.2f} {:>10}".format(
+            scope, metric, delta["baseline"], delta["candidate"],
+            "{:+.1f}%".format(delta["change_pct"]) if delta["change_pct"] is not None else "-"
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares two benchmark results")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--json", action="store_true", help="Prints comparison as JSON")
+    args = parser.parse_args()
+
+    with open(args.baseline) as baseline_file, open(args.candidate) as candidate_file:
+        comparison = compare(json.load(baseline_file), json.load(candidate_file))
+
+    if args.json:
+        print(json.dumps(comparison, indent=2, sort_keys=True))
+    else:
+        print_table(comparison)
+
+
+if __name__ == "__main__":
+    main()
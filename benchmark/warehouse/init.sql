@@ -0,0 +1,26 @@
+-- Synthetic warehouse of the benchmark stack, loaded by postgres on first start
+-- Row counts below can be raised to benchmark bigger scans
+\set events 2000000
+\set users 100000
+
+CREATE TABLE users AS
+SELECT id,
+       (ARRAY['TR', 'DE', 'US', 'GB', 'FR', 'NL', 'BR', 'IN', 'JP', 'KR'])[1 + id % 10] AS country,
+       (ARRAY['free', 'basic', 'pro', 'enterprise'])[1 + (id / 7) % 4]                AS plan,
+       DATE '2019-01-01' + (id % 600)                                                   AS signup_date
+FROM generate_series(1, :users) AS id;
+
+CREATE TABLE events AS
+SELECT id,
+       1 + (random() * (:users - 1))::int                                              AS user_id,
+       TIMESTAMP '2020-01-01' + random() * INTERVAL '365 days'                         AS ts,
+       (ARRAY['page_view', 'click', 'signup', 'purchase', 'logout'])[1 + (random() * 4)::int] AS event_type,
+       (ARRAY['web', 'ios', 'android'])[1 + (random() * 2)::int]                      AS device,
+       round((random() * 200)::numeric, 2)                                             AS revenue,
+       (random() * 5000)::int                                                          AS duration_ms
+FROM generate_series(1, :events) AS id;
+
+CREATE INDEX events_ts_idx ON events (ts);
+CREATE INDEX events_user_id_idx ON events (user_id);
+ANALYZE users;
+ANALYZE events;
@@ -4,11 +4,14 @@
 # ---------------------------------------------
 declare -A __SERVICE_PORTS__
 declare -A __SUPERSET_DAEMONS__
+declare -a __HEALTHCHECKS__
 
 __SERVICE_PORTS__[postgresql]="5432"
 __SERVICE_PORTS__[mysql]="3306"
 __SERVICE_PORTS__[redis]="6379"
 __SERVICE_PORTS__[rabbitmq]="5672"
+__SERVICE_PORTS__[memcached]="11211"
+__SERVICE_PORTS__[statsd]="8125"
 
 __SUPERSET_DAEMONS__[init]=init_superset
 __SUPERSET_DAEMONS__[webserver]=run_superset_webserver
@@ -59,6 +62,7 @@ function __retry_loop__() {
 # $2: Component type
 # $3: Component hostname
 # $4: Component port
+# $5: Credentials env var prefix (optional, used by database probes)
 function __health_checker__() {
   if [[ "$3" == "" ]]; then
     __log__ "Superset $1 host is not defined. Exiting ✘..."
@@ -67,23 +71,35 @@ function __health_checker__() {
     __log__ "Superset $1 host is $3. OK ✔"
   fi
 
-  __retry_loop__ "nc -z $3 $4" \
-                 "Superset $1 healtcheck started ($1_type: \"$2\", $1_host: \"$3\", $1_port: \"$4\")..." \
-                 "Superset $1 healthcheck failed ($1_type: \"$2\", $1_host: \"$3\", $1_port: \"$4\")..." \
-                 "Waiting $1 is ready ($1_type: \"$2\", $1_host: \"$3\", $1_port: \"$4\")" \
-                 "Superset $1 is ready ($1_type: \"$2\", $1_host: \"$3\", $1_port: \"$4\") ✔"
+  __HEALTHCHECKS__+=("$1|$2|$3|$4|$5")
+}
+
+# Probes every registered component concurrently with protocol level checks, exits when any of them fails
+function __run_healthchecks__() {
+  if [[ ${#__HEALTHCHECKS__[@]} -eq 0 ]]; then
+    return
+  fi
+
+  python -m superset_docker.healthcheck "${__HEALTHCHECKS__[@]}"
+
+  if [[ $? -ne 0 ]]; then
+    __log__ "Superset healthchecks failed. Exiting now..."
+    exit 1
+  fi
+
+  __HEALTHCHECKS__=()
 }
 
 # $1: Component name
 # $2: Component type
-# $3: Memcached servers
-function __memcached_servers_healthcheck__() {
-  IFS="," read -r -a MEMCACHED_SERVERS <<< "$3"
+# $3: Servers (host:port,host:port,...)
+function __servers_healthcheck__() {
+  IFS="," read -r -a SERVERS <<< "$3"
 
-  for server in ${MEMCACHED_SERVERS[@]}; do
+  for server in ${SERVERS[@]}; do
     IFS=":" read -r -a SERVER_INFO <<< $server
 
-    __health_checker__ "$1" "$2" ${SERVER_INFO[0]} ${SERVER_INFO[1]}
+    __health_checker__ "$1" "$2" ${SERVER_INFO[0]} ${SERVER_INFO[1]:-${__SERVICE_PORTS__[$2]}}
   done
 }
 
@@ -96,9 +112,13 @@ function __cache_or_results_backend_healthcheck__() {
   memcached_servers=$2_MEMCACHED_SERVERS
 
   if [[ "${!type:=null}" == "redis" ]]; then
-    __health_checker__ "$1" "${!type}" "${!redis_host}" "${!redis_port:=${__SERVICE_PORTS__[redis]}}"
+    if [[ "${REDIS_POOL_MODE:=standalone}" == "standalone" ]]; then
+      __health_checker__ "$1" "${!type}" "${!redis_host}" "${!redis_port:=${__SERVICE_PORTS__[redis]}}"
+    else
+      __servers_healthcheck__ "$1" "${!type}" "${REDIS_POOL_NODES}"
+    fi
   elif [[ "${!type:=null}" == "memcached" ]]; then
-    __memcached_servers_healthcheck__ "$1" "${!type}" "${!memcached_servers}"
+    __servers_healthcheck__ "$1" "${!type}" "${!memcached_servers}"
   fi
 }
 
@@ -119,7 +139,8 @@ function run_common_healthchecks() {
   __health_checker__ "${SUPERSET_COMPONENT_METADATA_DATABASE}" \
                      "${METADATA_DB_TYPE:=postgresql}" \
                      "${METADATA_DB_HOST}" \
-                     "${METADATA_DB_PORT:=${__SERVICE_PORTS__[${METADATA_DB_TYPE:=postgresql}]}}"
+                     "${METADATA_DB_PORT:=${__SERVICE_PORTS__[${METADATA_DB_TYPE:=postgresql}]}}" \
+                     "METADATA_DB"
 
   # Main cache health check
   __cache_or_results_backend_healthcheck__ "${SUPERSET_COMPONENT_CACHE}" "CACHE_CONFIG_CACHE"
@@ -135,7 +156,7 @@ function run_common_healthchecks() {
       __health_checker__ "${SUPERSET_COMPONENT_STATS_LOGGER_STATSD}" \
                          "${STATS_LOGGER_TYPE}" \
                          "${STATSD_STATS_LOGGER_HOST}" \
-                         "${STATSD_STATS_LOGGER_PORT}"
+                         "${STATSD_STATS_LOGGER_PORT:=${__SERVICE_PORTS__[statsd]}}"
   fi
 }
 
@@ -163,19 +184,58 @@ function init_superset() {
 }
 
 function run_superset_webserver() {
-  __retry_loop__ "gunicorn -b 0.0.0.0:8088 -w ${GUNICORN_WORKERS:=4} -k gevent --timeout 120 --limit-request-line 0 --limit-request-field_size 0 superset.app:create_app()" \
+  __retry_loop__ "gunicorn -c ${GUNICORN_CONFIG_PATH} superset.app:create_app()" \
                  "Running Superset webserver..." \
                  "Superset webserver cannot be started!" \
                  "Waiting Superset webserver to start..." \
                  "Superset webserver successfully started!"
 }
 
+# $1: Profile env var prefix
+# $2: Setting name
+# $3: Default value
+function __worker_profile_setting__() {
+  setting="$1_$2"
+
+  echo "${!setting:-$3}"
+}
+
+# $1: Worker profile name (optional). Profile settings are read from CELERY_WORKER_PROFILE_<NAME>_* env vars and
+#     fall back to the single worker settings
 function run_celery_worker() {
-  __retry_loop__ "celery worker --app=superset.tasks.celery_app:app --pool=${CELERY_BROKER_POOL_TYPE:=prefork} -O fair -c ${CELERY_BROKER_CONCURRENCY:=4} -E" \
-                 "Running Celery Worker..." \
-                 "Celery Worker cannot be started!" \
-                 "Waiting Celery Worker to start..." \
-                 "Celery Worker successfully started!"
+  profile="${1:-default}"
+  prefix="CELERY_WORKER_PROFILE_${profile^^}"
+  pool=$(__worker_profile_setting__ "${prefix}" POOL "${CELERY_BROKER_POOL_TYPE:=prefork}")
+  concurrency=$(__worker_profile_setting__ "${prefix}" CONCURRENCY "${CELERY_BROKER_CONCURRENCY:=4}")
+  prefetch_multiplier=$(__worker_profile_setting__ "${prefix}" PREFETCH_MULTIPLIER "${CELERY_WORKER_PREFETCH_MULTIPLIER:=4}")
+  queues=$(__worker_profile_setting__ "${prefix}" QUEUES "${CELERY_WORKER_QUEUES}")
+  max_tasks_per_child=$(__worker_profile_setting__ "${prefix}" MAX_TASKS_PER_CHILD "${CELERY_WORKER_MAX_TASKS_PER_CHILD}")
+  max_memory_per_child=$(__worker_profile_setting__ "${prefix}" MAX_MEMORY_PER_CHILD "${CELERY_WORKER_MAX_MEMORY_PER_CHILD}")
+
+  worker_options="--pool=${pool} -O fair -c ${concurrency} -E --prefetch-multiplier=${prefetch_multiplier}"
+
+  # Workers of the same container need distinct node names
+  if [[ "$1" != "" ]]; then
+    worker_options="${worker_options} -n ${profile}@%h"
+  fi
+
+  if [[ "${queues}" != "" ]]; then
+    worker_options="${worker_options} -Q ${queues}"
+  fi
+
+  if [[ "${max_tasks_per_child}" != "" ]]; then
+    worker_options="${worker_options} --max-tasks-per-child=${max_tasks_per_child}"
+  fi
+
+  if [[ "${max_memory_per_child}" != "" ]]; then
+    worker_options="${worker_options} --max-memory-per-child=${max_memory_per_child}"
+  fi
+
+  __retry_loop__ "celery worker --app=superset.tasks.celery_app:app ${worker_options}" \
+                 "Running Celery Worker (profile: \"${profile}\")..." \
+                 "Celery Worker (profile: \"${profile}\") cannot be started!" \
+                 "Waiting Celery Worker (profile: \"${profile}\") to start..." \
+                 "Celery Worker (profile: \"${profile}\") successfully started!"
 }
 
 function run_celery_flower() {
@@ -186,26 +246,92 @@ function run_celery_flower() {
                  "Celery Flower successfully started!"
 }
 
+# Readiness probe of Kubernetes: dependency checks of startup run once, then daemons of the container must be serving
+function run_readiness_checks() {
+  # Healthcheck processes read it from environment
+  export SUPERSET_MAX_RETRY_TIMES=0
+
+  run_common_healthchecks
+
+  if [[ " ${SUPERSET_DAEMONS[@]} " =~ [[:space:]]worker(:[^[:space:]]*)?[[:space:]] ]]; then
+      run_worker_healthchecks
+  fi
+
+  __run_healthchecks__
+
+  # Webserver is ready once gunicorn workers loaded the app and answer, so scaled out pods take traffic warm
+  if [[ " ${SUPERSET_DAEMONS[@]} " =~ [[:space:]]webserver[[:space:]] ]]; then
+      python -c "import sys, urllib.request; sys.exit(urllib.request.urlopen(sys.argv[1], timeout=5).status != 200)" \
+             "http://localhost:${SUPERSET_WEBSERVER_PORT:=8088}/health" || exit 1
+  fi
+
+  if [[ " ${SUPERSET_DAEMONS[@]} " =~ [[:space:]]worker(:[^[:space:]]*)?[[:space:]] ]]; then
+      pgrep -f "celery worker" > /dev/null || exit 1
+  fi
+}
+
 function main() {
+  # Metrics of every gunicorn worker and Celery child are written there and aggregated on /metrics
+  if [[ "${STATS_LOGGER_TYPE:=dummy}" == "prometheus" ]]; then
+    export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:=/tmp/superset_prometheus}"
+    export prometheus_multiproc_dir="${PROMETHEUS_MULTIPROC_DIR}"
+    rm -rf "${PROMETHEUS_MULTIPROC_DIR}" && mkdir -p "${PROMETHEUS_MULTIPROC_DIR}"
+  fi
+
+  # Opt-in since it imports the configs in an extra process, after Prometheus setup which importing them relies on
+  if [[ "${SUPERSET_CONFIG_CHECK_ON_STARTUP:=false}" == "true" ]]; then
+    __log__ "Checking Superset configuration..."
+
+    python -m superset_docker.env --check
+
+    if [[ $? -ne 0 ]]; then
+      __log__ "Superset configuration is not valid. Exiting ✘..."
+      exit 1
+    fi
+  fi
+
   run_common_healthchecks
 
   if [[ "${SUPERSET_DAEMONS}" != "" ]]; then
+      # Worker dependencies are checked together with common ones so all probes run concurrently
+      if [[ " ${SUPERSET_DAEMONS[@]} " =~ [[:space:]]worker(:[^[:space:]]*)?[[:space:]] ]]; then
+          run_worker_healthchecks
+      fi
+
+      __run_healthchecks__
+
+      background_daemons=0
+
+      # Daemons can be given as "<daemon>:<profile>" (e.g. "worker:sqllab") and each one is supervised separately
       for daemon in ${SUPERSET_DAEMONS[@]}; do
-          if [[ "$daemon" == "init" ]]; then
-              ${__SUPERSET_DAEMONS__[$daemon]}
-          else
-              if [[ "$daemon" == "worker" ]]; then
-                  run_worker_healthchecks
-              fi
+          daemon_name="${daemon%%:*}"
+          daemon_profile=""
 
-              ${__SUPERSET_DAEMONS__[$daemon]} &
+          if [[ "$daemon" == *:* ]]; then
+              daemon_profile="${daemon#*:}"
+          fi
+
+          if [[ "$daemon_name" == "init" ]]; then
+              ${__SUPERSET_DAEMONS__[$daemon_name]}
+          else
+              ${__SUPERSET_DAEMONS__[$daemon_name]} ${daemon_profile} &
+              (( background_daemons = background_daemons + 1 ))
           fi
       done
 
+      # Container running only init (e.g. a Kubernetes Job) exits once it is done
+      if [[ $background_daemons -eq 0 ]]; then
+          exit 0
+      fi
+
       tail -f /dev/null
   else
       __log__ "Any Superset daemons not defined. Exiting..."
   fi
 }
 
-main
\ No newline at end of file
+if [[ "$1" == "readiness" ]]; then
+  run_readiness_checks
+else
+  main
+fi
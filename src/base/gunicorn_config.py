@@ -0,0 +1,84 @@
+# Gunicorn settings of Superset webserver, read from environment variables
+# -------------------------------------------------
+import multiprocessing
+from os import environ
+from superset_docker.env import get_env, report_error
+
+
+def get_cpu_quota():
+    # cgroup v2 exposes "<quota> <period>", v1 exposes quota and period in separate files
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+
+        if quota != "max":
+            return float(quota) / float(period)
+    except (IOError, ValueError):
+        pass
+
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as cfs_quota, \
+                open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as cfs_period:
+            quota, period = int(cfs_quota.read()), int(cfs_period.read())
+
+        if quota > 0:
+            return float(quota) / period
+    except (IOError, ValueError):
+        pass
+
+    return float(multiprocessing.cpu_count())
+
+
+def get_workers():
+    workers = get_env("GUNICORN_WORKERS", default="4")
+
+    if workers == "auto":
+        return max(int(get_cpu_quota() * get_env("GUNICORN_WORKERS_PER_CPU", default=2, cast=float)) + 1, 2)
+
+    try:
+        return int(workers)
+    except ValueError:
+        report_error("Wrong value \"{}\" of \"GUNICORN_WORKERS\" (expected int or auto)".format(workers))
+
+        return 4
+
+
+bind = get_env("GUNICORN_BIND", default="{}:{}".format(get_env("SUPERSET_WEBSERVER_ADDRESS", default="0.0.0.0"),
+                                                        get_env("SUPERSET_WEBSERVER_PORT", default=8088, cast=int)))
+workers = get_workers()
+worker_class = get_env("GUNICORN_WORKER_CLASS", default="gevent", choices=["sync", "gthread", "gevent", "eventlet"])
+threads = get_env("GUNICORN_THREADS", default=1, cast=int)
+worker_connections = get_env("GUNICORN_WORKER_CONNECTIONS", default=1000, cast=int)
+backlog = get_env("GUNICORN_BACKLOG", default=2048, cast=int)
+keepalive = get_env("GUNICORN_KEEPALIVE", default=2, cast=int)
+# Gunicorn kills workers a little after Superset gives up on a request so Superset can still answer with an error
+timeout = get_env("GUNICORN_TIMEOUT",
+                  default=get_env("SUPERSET_WEBSERVER_TIMEOUT", default=60, cast=int) +
+                  get_env("GUNICORN_TIMEOUT_MARGIN", default=10, cast=int),
+                  cast=int)
+graceful_timeout = get_env("GUNICORN_GRACEFUL_TIMEOUT", default=30, cast=int)
+max_requests = get_env("GUNICORN_MAX_REQUESTS", default=0, cast=int)
+max_requests_jitter = get_env("GUNICORN_MAX_REQUESTS_JITTER", default=0, cast=int)
+preload_app = get_env("GUNICORN_PRELOAD", default=False, cast=bool)
+limit_request_line = get_env("GUNICORN_LIMIT_REQUEST_LINE", default=0, cast=int)
+limit_request_field_size = get_env("GUNICORN_LIMIT_REQUEST_FIELD_SIZE", default=0, cast=int)
+accesslog = get_env("GUNICORN_ACCESS_LOG")
+errorlog = get_env("GUNICORN_ERROR_LOG", default="-")
+loglevel = get_env("GUNICORN_LOG_LEVEL", default="info")
+
+
+def post_fork(server, worker):
+    # Connections opened while preloading the app in master must not be shared by forked workers
+    if preload_app:
+        from superset.extensions import db
+
+        with worker.app.wsgi().app_context():
+            db.engine.dispose()
+
+
+def child_exit(server, worker):
+    # Gauges of dead workers must not be summed into /metrics anymore
+    if environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
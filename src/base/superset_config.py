@@ -1,33 +1,23 @@
 # Written by Mutlu Polatcan
 # 05.05.2020
 # -------------------------------------------------
-# TODO Write environment variables types and default values
+# Environment variables, their types, defaults and valid values can be listed with
+# "python -m superset_docker.env --dump" and validated with "python -m superset_docker.env --check"
 import json
-from os import environ
 from dateutil import tz
 from celery.schedules import crontab
+from kombu import Queue
 from flask_appbuilder.security.manager import AUTH_DB, AUTH_LDAP, AUTH_OID, AUTH_REMOTE_USER
 from cachelib import SimpleCache, RedisCache, MemcachedCache
+from sqlalchemy.pool import NullPool
 from s3cache.s3cache import S3Cache
+from superset_docker.caches import COMPRESSION_CODECS, CompressedCache, DiskCache, LRUMemoryCache, TieredCache
+from superset_docker.env import get_env
+from superset_docker.memcached_clients import get_memcached_behaviors, get_memcached_client
+from superset_docker.metadata_db import route_reads_to_replica
+from superset_docker.redis_clients import get_redis_client, parse_nodes
 from superset.stats_logger import DummyStatsLogger, StatsdStatsLogger
 
-ENV_VAR_TYPE_CASTER = {
-    int: lambda value: int(value),
-    float: lambda value: float(value),
-    bool: lambda value: str(value).lower() == "true",
-    list: lambda value: value.split(","),
-    str: lambda value: value
-}
-
-
-def get_env(env_var, default=None, cast: type = str):
-    value = environ.get(env_var, None)
-
-    if value:
-        return ENV_VAR_TYPE_CASTER[cast](value)
-    else:
-        return default
-
 # --------------------------------------------------------------------
 
 
@@ -35,7 +25,7 @@ DRUID_TIMEZONES = {"utc": tz.tzutc(), "local": tz.tzlocal()}
 
 AUTH_TYPES = {"oid": AUTH_OID, "db": AUTH_DB, "ldap": AUTH_LDAP, "remote_user": AUTH_REMOTE_USER}
 
-METADATA_DB_PREFIXES = {"postgresql": "postgresql+psycopg2", "mysql": "mysql", "sqllite": "sqllite"}
+METADATA_DB_PREFIXES = {"postgresql": "postgresql+psycopg2", "mysql": "mysql", "sqlite": "sqlite"}
 
 METADATA_DB_DEFAULT_PORTS = {"postgresql": 5432, "mysql": 3306}
 
@@ -43,39 +33,110 @@ BROKER_PREFIXES = {"redis": "redis", "rabbitmq": "pyamqp"}
 
 BROKER_DEFAULT_PORTS = {"redis": 6379, "rabbitmq": 5672}
 
+CACHE_TYPES = ["null", "simple", "filesystem", "redis", "redissentinel", "rediscluster", "memcached", "saslmemcached",
+               "spreadsaslmemcached", "uwsgi"]
+
+REDIS_POOL_MODES = ["standalone", "sentinel", "cluster"]
+
+REDIS_POOL_OPTIONS = {
+    "mode": get_env("REDIS_POOL_MODE", default="standalone", choices=REDIS_POOL_MODES),
+    "nodes": get_env("REDIS_POOL_NODES", default=[], cast=list),
+    "sentinel_master": get_env("REDIS_POOL_SENTINEL_MASTER", default="mymaster"),
+    "max_connections": get_env("REDIS_POOL_MAX_CONNECTIONS", cast=int),
+    "pool_timeout": get_env("REDIS_POOL_TIMEOUT", default=20, cast=float),
+    "socket_timeout": get_env("REDIS_POOL_SOCKET_TIMEOUT", cast=float),
+    "socket_connect_timeout": get_env("REDIS_POOL_SOCKET_CONNECT_TIMEOUT", cast=float),
+    "socket_keepalive": get_env("REDIS_POOL_SOCKET_KEEPALIVE", default=False, cast=bool),
+    "health_check_interval": get_env("REDIS_POOL_HEALTH_CHECK_INTERVAL", default=0, cast=int)
+}
+
+MEMCACHED_HASHINGS = ["modula", "ketama"]
+
+MEMCACHED_CLIENT_OPTIONS = {
+    "binary": get_env("MEMCACHED_CLIENT_BINARY", default=True, cast=bool),
+    "remove_failed": get_env("MEMCACHED_CLIENT_REMOVE_FAILED", default=3, cast=int),
+    "retry_timeout": get_env("MEMCACHED_CLIENT_RETRY_TIMEOUT", default=30, cast=int),
+    "dead_timeout": get_env("MEMCACHED_CLIENT_DEAD_TIMEOUT", default=60, cast=int),
+    "connect_timeout": get_env("MEMCACHED_CLIENT_CONNECT_TIMEOUT", default=1.0, cast=float),
+    "io_timeout": get_env("MEMCACHED_CLIENT_IO_TIMEOUT", default=1.0, cast=float),
+    "pool_size": get_env("MEMCACHED_CLIENT_POOL_SIZE", default=8, cast=int)
+}
+
+
+def get_memcached_servers(servers, hashing_env_var, username=None, password=None):
+    """Returns a shared ketama client in place of server list when hashing env var is ketama."""
+    if get_env(hashing_env_var, default="modula", choices=MEMCACHED_HASHINGS) != "ketama":
+        return servers
+
+    return get_memcached_client(servers, username=username, password=password, hashing="ketama",
+                                **MEMCACHED_CLIENT_OPTIONS)
+
+
 SUPERSET_RESULTS_BACKENDS = {
     "simple": lambda: SimpleCache(
         threshold=get_env("SUPERSET_SIMPLE_RESULTS_BACKEND_THRESHOLD", default=10, cast=int),
         default_timeout=get_env("SUPERSET_SIMPLE_RESULTS_BACKEND_DEFAULT_TIMEOUT", default=300, cast=float)
     ),
     "redis": lambda: RedisCache(
-        host=get_env("SUPERSET_REDIS_RESULTS_BACKEND_HOST"),
-        port=get_env("SUPERSET_REDIS_RESULTS_BACKEND_PORT", default=6379, cast=int),
-        password=get_env("SUPERSET_REDIS_RESULTS_BACKEND_PASSWORD"),
+        host=get_redis_client(
+            host=get_env("SUPERSET_REDIS_RESULTS_BACKEND_HOST"),
+            port=get_env("SUPERSET_REDIS_RESULTS_BACKEND_PORT", default=6379, cast=int),
+            password=get_env("SUPERSET_REDIS_RESULTS_BACKEND_PASSWORD"),
+            db=get_env("SUPERSET_REDIS_RESULTS_BACKEND_DB", default=0, cast=int),
+            **REDIS_POOL_OPTIONS
+        ),
         key_prefix=get_env("SUPERSET_REDIS_RESULTS_BACKEND_KEY_PREFIX", default="superset_results"),
-        db=get_env("SUPERSET_REDIS_RESULTS_BACKEND_DB", default=0, cast=int),
         default_timeout=get_env("SUPERSET_REDIS_RESULTS_BACKEND_DEFAULT_TIMEOUT", default=300, cast=float)
     ),
     "memcached": lambda: MemcachedCache(
-        servers=get_env("SUPERSET_MEMCACHED_RESULTS_BACKEND_SERVERS", default=[], cast=list),
+        servers=get_memcached_servers(get_env("SUPERSET_MEMCACHED_RESULTS_BACKEND_SERVERS", default=[], cast=list),
+                                      "SUPERSET_MEMCACHED_RESULTS_BACKEND_HASHING"),
         default_timeout=get_env("SUPERSET_MEMCACHED_RESULTS_BACKEND_DEFAULT_TIMEOUT", default=300, cast=float),
         key_prefix=get_env("SUPERSET_MEMCACHED_RESULTS_BACKEND_KEY_PREFIX", default="superset_results")
     ),
     "s3": lambda: S3Cache(
         s3_bucket=get_env("SUPERSET_S3_RESULTS_BACKEND_BUCKET_NAME"),
         key_prefix=get_env("SUPERSET_S3_RESULTS_BACKEND_KEY_PREFIX", default="superset_results")
+    ),
+    "filesystem": lambda: DiskCache(
+        cache_dir=get_env("SUPERSET_FILESYSTEM_RESULTS_BACKEND_DIR", default="/home/superset/superset/results"),
+        max_size=get_env("SUPERSET_FILESYSTEM_RESULTS_BACKEND_MAX_SIZE_IN_BYTES",
+                         default=10 * 1024 * 1024 * 1024,
+                         cast=int),
+        default_timeout=get_env("SUPERSET_FILESYSTEM_RESULTS_BACKEND_DEFAULT_TIMEOUT", default=300, cast=float),
+        sweep_interval=get_env("SUPERSET_FILESYSTEM_RESULTS_BACKEND_SWEEP_INTERVAL", default=60, cast=float),
+        low_watermark=get_env("SUPERSET_FILESYSTEM_RESULTS_BACKEND_LOW_WATERMARK", default=0.9, cast=float)
+    ),
+    "tiered": lambda: TieredCache(
+        local=LRUMemoryCache(
+            max_size=get_env("SUPERSET_TIERED_RESULTS_BACKEND_LOCAL_MAX_SIZE_IN_BYTES",
+                             default=64 * 1024 * 1024,
+                             cast=int),
+            default_timeout=get_env("SUPERSET_TIERED_RESULTS_BACKEND_LOCAL_DEFAULT_TIMEOUT", default=60, cast=float)
+        ),
+        remote=get_results_backend(get_env("SUPERSET_TIERED_RESULTS_BACKEND_REMOTE_TYPE",
+                                           default="redis",
+                                           choices=["simple", "redis", "memcached", "s3", "filesystem"]),
+                                   required=True,
+                                   excluded_types=["tiered"])
     )
 }
 
 CELERY_RESULT_BACKENDS_URIS = {
-    "redis": "redis://{password}{host}:{port}/{db}".format(
-        password="{}@".format(get_env("CELERY_REDIS_RESULT_BACKEND_PASSWORD"))
-                 if get_env("CELERY_REDIS_RESULT_BACKEND_PASSWORD") else "",
-        host=get_env("CELERY_REDIS_RESULT_BACKEND_HOST"),
-        port=get_env("CELERY_REDIS_RESULT_BACKEND_PORT", default=6379),
-        db=get_env("CELERY_REDIS_RESULT_BACKEND_DB", default=1)
-    ),
-    "memcached": "cache+memcached://{servers}/".format(
+    "redis": lambda: ";".join([
+        "{scheme}://{password}{host}:{port}/{db}".format(
+            scheme="sentinel" if REDIS_POOL_OPTIONS["mode"] == "sentinel" else "redis",
+            password="{}@".format(get_env("CELERY_REDIS_RESULT_BACKEND_PASSWORD"))
+                     if get_env("CELERY_REDIS_RESULT_BACKEND_PASSWORD") else "",
+            host=host,
+            port=port,
+            db=get_env("CELERY_REDIS_RESULT_BACKEND_DB", default=1)
+        )
+        for host, port in (parse_nodes(REDIS_POOL_OPTIONS["nodes"]) if REDIS_POOL_OPTIONS["mode"] == "sentinel" else
+                           [(get_env("CELERY_REDIS_RESULT_BACKEND_HOST"),
+                             get_env("CELERY_REDIS_RESULT_BACKEND_PORT", default=6379))])
+    ]),
+    "memcached": lambda: "cache+memcached://{servers}/".format(
         servers=";".join(get_env("CELERY_MEMCACHED_RESULT_BACKEND_SERVERS", default=[], cast=list))
     )
 }
@@ -86,12 +147,40 @@ STATS_LOGGERS = {
         host=get_env("STATSD_STATS_LOGGER_HOST", default="localhost"),
         port=get_env("STATSD_STATS_LOGGER_PORT", default=8125, cast=int),
         prefix=get_env("STATSD_STATS_LOGGER_PREFIX", default="superset")
-    )
+    ),
+    "prometheus": lambda: get_prometheus_stats_logger(prefix=get_env("PROMETHEUS_STATS_LOGGER_PREFIX", default=""))
 }
 
 
-def get_db_or_broker_uri(env_var_prefix, default_prefixes, default_ports):
-    type = get_env("{}_TYPE".format(env_var_prefix))
+def get_results_backend(type, required=False, excluded_types=()):
+    if type in excluded_types or (required and type not in SUPERSET_RESULTS_BACKENDS):
+        raise Exception("Wrong results backend type \"{}\"".format(type))
+
+    results_backend = SUPERSET_RESULTS_BACKENDS.get(type, lambda: None)()
+
+    # Tiered backend keeps decompressed payloads locally, only its remote tier is compressed
+    if results_backend is None or type == "tiered":
+        return results_backend
+
+    compression_codec = get_env("SUPERSET_RESULTS_BACKEND_COMPRESSION_CODEC",
+                                default="none",
+                                choices=COMPRESSION_CODECS)
+    chunk_size = get_env("SUPERSET_RESULTS_BACKEND_CHUNK_SIZE_IN_BYTES", default=0, cast=int)
+
+    if compression_codec == "none" and chunk_size <= 0:
+        return results_backend
+
+    return CompressedCache(
+        cache=results_backend,
+        codec=compression_codec,
+        level=get_env("SUPERSET_RESULTS_BACKEND_COMPRESSION_LEVEL", cast=int),
+        chunk_size=chunk_size
+    )
+
+
+def get_db_or_broker_uri(env_var_prefix, default_prefixes, default_ports, host_env_var_prefix=None):
+    type = get_env("{}_TYPE".format(env_var_prefix), choices=default_prefixes)
+    host_env_var_prefix = host_env_var_prefix or env_var_prefix
 
     try:
         username = get_env("{}_USERNAME".format(env_var_prefix))
@@ -101,17 +190,248 @@ def get_db_or_broker_uri(env_var_prefix, default_prefixes, default_ports):
             prefix=default_prefixes[type],
             username="{}{}".format(username, ":" if password else "@") if username else "",
             password="{}@".format(password) if password else "",
-            host=get_env("{}_HOST".format(env_var_prefix)),
-            port=get_env("{}_PORT".format(env_var_prefix), default=default_ports.get(type, None)),
+            host=get_env("{}_HOST".format(host_env_var_prefix)),
+            port=get_env("{}_PORT".format(host_env_var_prefix), default=default_ports.get(type, None)),
             db=get_env("{}_DATABASE".format(env_var_prefix))
         )
     except Exception:
         raise Exception("Wrong type \"{}\"".format(type))
 
 
+def get_sqlalchemy_engine_options(env_var_prefix):
+    type = get_env("{}_TYPE".format(env_var_prefix))
+    statement_timeout = get_env("{}_STATEMENT_TIMEOUT_IN_MS".format(env_var_prefix), cast=int)
+    connect_timeout = get_env("{}_CONNECT_TIMEOUT".format(env_var_prefix), cast=int)
+    engine_options = {}
+    connect_args = {}
+
+    if type not in METADATA_DB_DEFAULT_PORTS:
+        return engine_options
+
+    # PgBouncer pools connections itself and rejects session startup parameters in transaction pooling mode
+    if get_env("{}_PGBOUNCER_MODE".format(env_var_prefix), default=False, cast=bool):
+        engine_options["poolclass"] = NullPool
+    else:
+        engine_options.update({
+            "pool_size": get_env("{}_POOL_SIZE".format(env_var_prefix), default=5, cast=int),
+            "max_overflow": get_env("{}_POOL_MAX_OVERFLOW".format(env_var_prefix), default=10, cast=int),
+            "pool_timeout": get_env("{}_POOL_TIMEOUT".format(env_var_prefix), default=30, cast=int),
+            "pool_recycle": get_env("{}_POOL_RECYCLE".format(env_var_prefix), default=3600, cast=int),
+            "pool_pre_ping": get_env("{}_POOL_PRE_PING".format(env_var_prefix), default=True, cast=bool)
+        })
+
+        if statement_timeout and type == "postgresql":
+            connect_args["options"] = "-c statement_timeout={}".format(statement_timeout)
+        elif statement_timeout and type == "mysql":
+            connect_args["init_command"] = "SET SESSION max_execution_time={}".format(statement_timeout)
+
+    if connect_timeout:
+        connect_args["connect_timeout"] = connect_timeout
+
+    if connect_args:
+        engine_options["connect_args"] = connect_args
+
+    return engine_options
+
+
+def get_prometheus_stats_logger(prefix):
+    # Imported only when selected since prometheus_client must see PROMETHEUS_MULTIPROC_DIR at import time
+    from superset_docker.stats import PrometheusStatsLogger
+
+    return PrometheusStatsLogger(prefix=prefix)
+
+
+def is_prometheus_enabled():
+    return get_env("STATS_LOGGER_TYPE", default="dummy", choices=STATS_LOGGERS) == "prometheus"
+
+
+def instrument_results_backend(results_backend):
+    if results_backend is None or not is_prometheus_enabled():
+        return results_backend
+
+    from superset_docker.stats import InstrumentedCache
+
+    return InstrumentedCache(results_backend, "results_backend")
+
+
+def get_results_serialization_format():
+    return get_env("SUPERSET_RESULTS_BACKEND_SERIALIZATION_FORMAT", default="msgpack",
+                   choices=["msgpack", "arrow", "parquet"])
+
+
+def serialize_results_backend(results_backend):
+    serialization_format = get_results_serialization_format()
+
+    if results_backend is None or serialization_format == "msgpack":
+        return results_backend
+
+    from superset_docker.results_serialization import ArrowResultsCache
+
+    return ArrowResultsCache(
+        cache=results_backend,
+        format=serialization_format,
+        batch_size=get_env("SUPERSET_RESULTS_BACKEND_SERIALIZATION_BATCH_SIZE", default=65536, cast=int),
+        parquet_compression=get_env("SUPERSET_RESULTS_BACKEND_PARQUET_COMPRESSION",
+                                    default="snappy",
+                                    choices=["none", "snappy", "gzip", "brotli", "lz4", "zstd"])
+    )
+
+
+def get_query_result_cache():
+    from superset_docker.query_cache import QueryResultCache
+
+    return QueryResultCache(
+        client=get_redis_client(
+            host=get_env("QUERY_RESULT_CACHE_REDIS_HOST", default=get_env("CACHE_CONFIG_CACHE_REDIS_HOST")),
+            port=get_env("QUERY_RESULT_CACHE_REDIS_PORT",
+                         default=get_env("CACHE_CONFIG_CACHE_REDIS_PORT", default=6379, cast=int),
+                         cast=int),
+            password=get_env("QUERY_RESULT_CACHE_REDIS_PASSWORD", default=get_env("CACHE_CONFIG_CACHE_REDIS_PASSWORD")),
+            db=get_env("QUERY_RESULT_CACHE_REDIS_DB",
+                       default=get_env("CACHE_CONFIG_CACHE_REDIS_DB", default=0, cast=int),
+                       cast=int),
+            **REDIS_POOL_OPTIONS
+        ),
+        key_prefix=get_env("QUERY_RESULT_CACHE_KEY_PREFIX", default="superset_query_results"),
+        default_options={
+            "enabled": True,
+            "ttl": get_env("QUERY_RESULT_CACHE_DEFAULT_TTL", default=300, cast=int),
+            "stale_ttl": get_env("QUERY_RESULT_CACHE_DEFAULT_STALE_TTL", default=0, cast=int),
+            "max_payload_size": get_env("QUERY_RESULT_CACHE_DEFAULT_MAX_PAYLOAD_SIZE_IN_BYTES",
+                                        default=16 * 1024 * 1024,
+                                        cast=int)
+        },
+        database_options=json.loads(get_env("QUERY_RESULT_CACHE_DATABASES", default="{}")),
+        lock_timeout=get_env("QUERY_RESULT_CACHE_LOCK_TIMEOUT", default=300, cast=float),
+        wait_timeout=get_env("QUERY_RESULT_CACHE_WAIT_TIMEOUT", default=300, cast=float),
+        poll_interval=get_env("QUERY_RESULT_CACHE_POLL_INTERVAL", default=0.2, cast=float)
+    )
+
+
+def get_sqllab_events_redis_client():
+    return get_redis_client(
+        host=get_env("SQLLAB_EVENTS_REDIS_HOST", default=get_env("CACHE_CONFIG_CACHE_REDIS_HOST")),
+        port=get_env("SQLLAB_EVENTS_REDIS_PORT",
+                     default=get_env("CACHE_CONFIG_CACHE_REDIS_PORT", default=6379, cast=int),
+                     cast=int),
+        password=get_env("SQLLAB_EVENTS_REDIS_PASSWORD", default=get_env("CACHE_CONFIG_CACHE_REDIS_PASSWORD")),
+        db=get_env("SQLLAB_EVENTS_REDIS_DB",
+                   default=get_env("CACHE_CONFIG_CACHE_REDIS_DB", default=0, cast=int),
+                   cast=int),
+        **REDIS_POOL_OPTIONS
+    )
+
+
+def flask_app_mutator(app):
+    # Mutator runs before Superset registers its views, so replaced view methods are the ones exposed
+    if get_env("ENABLE_STREAMING_CSV_EXPORT", default=False, cast=bool):
+        from superset_docker.csv_export import install
+
+        install(batch_size=get_env("STREAMING_CSV_EXPORT_BATCH_SIZE", default=10000, cast=int),
+                gzip=get_env("STREAMING_CSV_EXPORT_GZIP", default=True, cast=bool))
+
+    if get_env("ENABLE_BROWSER_POOL", default=False, cast=bool):
+        from celery.signals import worker_process_init
+        from superset_docker.screenshots import install
+
+        prewarm = install(app,
+                          pool_options={
+                              "size": get_env("BROWSER_POOL_SIZE", default=1, cast=int),
+                              "max_waiting": get_env("BROWSER_POOL_MAX_WAITING_RENDERS", default=16, cast=int),
+                              "acquire_timeout": get_env("BROWSER_POOL_ACQUIRE_TIMEOUT", default=120, cast=float),
+                              "max_renders": get_env("BROWSER_POOL_MAX_RENDERS_PER_BROWSER", default=50, cast=int),
+                              "max_memory": get_env("BROWSER_POOL_MAX_MEMORY_PER_BROWSER_IN_BYTES",
+                                                    default=1024 * 1024 * 1024,
+                                                    cast=int),
+                              "render_timeout": get_env("BROWSER_POOL_RENDER_TIMEOUT", default=60, cast=int)
+                          },
+                          rerender_interval=get_env("THUMBNAIL_RERENDER_INTERVAL", default=3600, cast=int))
+
+        if get_env("BROWSER_POOL_PREWARM", default=False, cast=bool):
+            worker_process_init.connect(prewarm, weak=False)
+
+    if get_env("ENABLE_QUERY_RESULT_CACHE", default=False, cast=bool):
+        from superset_docker.query_cache import install
+
+        install(get_query_result_cache())
+
+    if get_env("ENABLE_SQLLAB_EVENTS", default=False, cast=bool):
+        from superset_docker.sqllab_events import QueryEventPublisher, install
+
+        client = get_sqllab_events_redis_client()
+        install(app,
+                QueryEventPublisher(client,
+                                    key_prefix=get_env("SQLLAB_EVENTS_KEY_PREFIX", default="superset_sqllab_events"),
+                                    retention=get_env("SQLLAB_EVENTS_RETENTION", default=86400, cast=int),
+                                    resync_interval=get_env("SQLLAB_EVENTS_RESYNC_INTERVAL", default=60, cast=int)),
+                subscriber_client=client,
+                stream_timeout=get_env("SQLLAB_EVENTS_STREAM_TIMEOUT", default=300, cast=int),
+                heartbeat_interval=get_env("SQLLAB_EVENTS_HEARTBEAT_INTERVAL", default=15, cast=float))
+
+    if get_env("ENABLE_BATCHED_EMAIL_REPORTS", default=False, cast=bool):
+        from superset_docker.email_reports import ReportMailer, SMTPConnectionPool, TokenBucket, install
+
+        install(ReportMailer(
+            SMTPConnectionPool(host=SMTP_HOST,
+                               port=SMTP_PORT,
+                               ssl=SMTP_SSL,
+                               starttls=SMTP_STARTTLS,
+                               user=SMTP_USER,
+                               password=SMTP_PASSWORD,
+                               size=get_env("EMAIL_REPORTS_SMTP_POOL_SIZE", default=2, cast=int),
+                               max_messages=get_env("EMAIL_REPORTS_SMTP_MAX_MESSAGES_PER_CONNECTION",
+                                                    default=100,
+                                                    cast=int),
+                               idle_check_interval=get_env("EMAIL_REPORTS_SMTP_IDLE_CHECK_INTERVAL",
+                                                           default=30,
+                                                           cast=float),
+                               timeout=get_env("EMAIL_REPORTS_SMTP_TIMEOUT", default=30, cast=float)),
+            TokenBucket(rate=get_env("EMAIL_REPORTS_SEND_RATE", default=1, cast=float),
+                        capacity=get_env("EMAIL_REPORTS_SEND_BURST", default=10, cast=int),
+                        client=get_redis_client(
+                            host=get_env("CACHE_CONFIG_CACHE_REDIS_HOST"),
+                            port=get_env("CACHE_CONFIG_CACHE_REDIS_PORT", default=6379, cast=int),
+                            password=get_env("CACHE_CONFIG_CACHE_REDIS_PASSWORD"),
+                            db=get_env("CACHE_CONFIG_CACHE_REDIS_DB", default=0, cast=int),
+                            **REDIS_POOL_OPTIONS
+                        ) if get_env("CACHE_CONFIG_CACHE_REDIS_HOST") else None),
+            mail_from=SMTP_MAIL_FROM,
+            bcc=[address.strip() for address in EMAIL_REPORT_BCC_ADDRESS.split(",")]
+            if EMAIL_REPORT_BCC_ADDRESS else [],
+            max_recipients=get_env("EMAIL_REPORTS_MAX_RECIPIENTS_PER_MESSAGE", default=50, cast=int),
+            dryrun=SCHEDULED_EMAIL_DEBUG_MODE
+        ))
+
+    if get_env("ENABLE_TABLE_NAMES_PREFETCH", default=False, cast=bool):
+        from superset_docker.table_metadata import blueprint
+
+        app.register_blueprint(blueprint)
+
+    if get_results_serialization_format() != "msgpack":
+        from superset_docker.results_serialization import init_app
+
+        init_app(app)
+
+    if is_prometheus_enabled():
+        from superset_docker.stats import init_app
+
+        init_app(app, metrics_path=get_env("PROMETHEUS_METRICS_PATH", default="/metrics"))
+
+    if SQLALCHEMY_BINDS.get("metadata_replica"):
+        from superset.extensions import db
+
+        route_reads_to_replica(app,
+                               db,
+                               "metadata_replica",
+                               get_env("METADATA_DB_REPLICA_ENDPOINTS",
+                                       default=["DashboardRestApi.get_list", "ChartRestApi.get_list",
+                                                "DashboardModelView.list", "SliceModelView.list"],
+                                       cast=list))
+
+
 def get_cache_config(env_var_prefix):
-    def set_config(config_dict, config_key, default=None, cast: type = str):
-        value = get_env("{}_{}".format(env_var_prefix, config_key), default=default, cast=cast)
+    def set_config(config_dict, config_key, default=None, cast: type = str, choices=None):
+        value = get_env("{}_{}".format(env_var_prefix, config_key), default=default, cast=cast, choices=choices)
 
         if value:
             config_dict[config_key] = value
@@ -126,22 +446,57 @@ def get_cache_config(env_var_prefix):
             config_dict=cache_config,
             config_key="CACHE_{}".format(cache_config_info[0]),
             default=cache_config_info[1] if len(cache_config_info) > 2 else None,
-            cast=cache_config_info[-1]
+            cast=cache_config_info[-1],
+            choices=CACHE_TYPES if cache_config_info[0] == "TYPE" else None
         )
 
+    # Redis client object passed as host makes cache use the shared connection pool
     if cache_config["CACHE_TYPE"] == "redis":
-        redis_password = cache_config.get("CACHE_REDIS_PASSWORD", None)
+        cache_config["CACHE_REDIS_HOST"] = get_redis_client(
+            host=cache_config.get("CACHE_REDIS_HOST", None),
+            port=cache_config.get("CACHE_REDIS_PORT", 6379),
+            password=cache_config.pop("CACHE_REDIS_PASSWORD", None),
+            db=cache_config.pop("CACHE_REDIS_DB", 0),
+            **REDIS_POOL_OPTIONS
+        )
 
-        cache_config["CACHE_REDIS_URL"] = "redis://{password}{host}:{port}/{db}".format(
-            password="{}@".format(redis_password) if redis_password else "",
-            host=cache_config.get("CACHE_REDIS_HOST", ""),
-            port=cache_config.get("CACHE_REDIS_PORT", ""),
-            db=cache_config.get("CACHE_REDIS_DB", "")
+    # Client object passed as server list makes cache use the shared ketama client
+    if cache_config["CACHE_TYPE"] == "memcached" and cache_config.get("CACHE_MEMCACHED_SERVERS"):
+        cache_config["CACHE_MEMCACHED_SERVERS"] = get_memcached_servers(
+            servers=cache_config["CACHE_MEMCACHED_SERVERS"].split(","),
+            hashing_env_var="{}_CACHE_MEMCACHED_HASHING".format(env_var_prefix),
+            username=get_env("{}_CACHE_MEMCACHED_USERNAME".format(env_var_prefix)),
+            password=cache_config.get("CACHE_MEMCACHED_PASSWORD")
         )
 
+    if cache_config["CACHE_TYPE"] != "null" and is_prometheus_enabled():
+        cache_config["CACHE_INSTRUMENTED_TYPE"] = cache_config["CACHE_TYPE"]
+        cache_config["CACHE_INSTRUMENTED_NAME"] = env_var_prefix.lower()
+        cache_config["CACHE_TYPE"] = "superset_docker.stats.instrumented_cache"
+
     return cache_config
 
 
+def get_celery_routes():
+    celery_routes = {}
+
+    for task_names, queue_env_var in [(["sql_lab.get_sql_results"], "CELERY_SQLLAB_QUEUE"),
+                                      (["email_reports.send", "email_reports.send_batch",
+                                        "email_reports.schedule_hourly"],
+                                       "CELERY_EMAIL_REPORTS_QUEUE"),
+                                      (["cache_chart_thumbnail", "cache_dashboard_thumbnail"],
+                                       "CELERY_THUMBNAILS_QUEUE"),
+                                      (["cache-warmup", "adaptive-cache-warmup", "adaptive-cache-warmup-chart",
+                                        "table-names-prefetch"],
+                                       "CELERY_CACHE_WARMUP_QUEUE")]:
+        queue = get_env(queue_env_var)
+
+        if queue:
+            celery_routes.update({task_name: {"queue": queue} for task_name in task_names})
+
+    return celery_routes
+
+
 def get_celery_beat_schedule():
     celery_beat_schedule = {
         "email_reports.schedule_hourly": {
@@ -162,6 +517,39 @@ def get_celery_beat_schedule():
                 "kwargs": cache_warmup["kwargs"]
             }
 
+    if get_env("ENABLE_ADAPTIVE_CACHE_WARMUP", default=False, cast=bool):
+        celery_beat_schedule["adaptive-cache-warmup"] = {
+            "task": "adaptive-cache-warmup",
+            "schedule": crontab(*get_env("ADAPTIVE_CACHE_WARMUP_SCHEDULE", default="*/5 * * * *").split()),
+            "kwargs": {
+                "since_in_hours": get_env("ADAPTIVE_CACHE_WARMUP_SINCE_IN_HOURS", default=24, cast=int),
+                "top_n": get_env("ADAPTIVE_CACHE_WARMUP_TOP_N_DASHBOARDS", default=20, cast=int),
+                "min_access_count": get_env("ADAPTIVE_CACHE_WARMUP_MIN_ACCESS_COUNT", default=1, cast=int),
+                "refresh_before_expiry_ratio": get_env("ADAPTIVE_CACHE_WARMUP_REFRESH_BEFORE_EXPIRY_RATIO",
+                                                       default=0.2,
+                                                       cast=float),
+                "max_concurrency_per_database": get_env("ADAPTIVE_CACHE_WARMUP_MAX_CONCURRENCY_PER_DATABASE",
+                                                        default=2,
+                                                        cast=int),
+                "max_warmups_per_run": get_env("ADAPTIVE_CACHE_WARMUP_MAX_WARMUPS_PER_RUN", default=50, cast=int),
+                "in_flight_timeout": get_env("ADAPTIVE_CACHE_WARMUP_IN_FLIGHT_TIMEOUT", default=600, cast=int)
+            }
+        }
+
+    if get_env("ENABLE_TABLE_NAMES_PREFETCH", default=False, cast=bool):
+        celery_beat_schedule["table-names-prefetch"] = {
+            "task": "table-names-prefetch",
+            "schedule": crontab(*get_env("TABLE_NAMES_PREFETCH_SCHEDULE", default="*/10 * * * *").split()),
+            "kwargs": {
+                "databases": json.loads(get_env("TABLE_NAMES_PREFETCH_DATABASES", default="{}")),
+                "cache_timeout": get_env("TABLE_NAMES_PREFETCH_CACHE_TIMEOUT", default=3600, cast=int),
+                "columns_max_age": get_env("TABLE_NAMES_PREFETCH_COLUMNS_MAX_AGE_IN_SECS", default=86400, cast=int),
+                "max_column_refreshes": get_env("TABLE_NAMES_PREFETCH_MAX_COLUMN_REFRESHES_PER_RUN",
+                                                default=500,
+                                                cast=int)
+            }
+        }
+
     return celery_beat_schedule
 
 
@@ -172,7 +560,7 @@ APP_NAME = get_env("APP_NAME", default="Superset")
 # ------------------------------------------------------
 
 # ------------------------------------------------------
-AUTH_TYPE = AUTH_TYPES.get(get_env("AUTH_TYPE", default="db"))
+AUTH_TYPE = AUTH_TYPES.get(get_env("AUTH_TYPE", default="db", choices=AUTH_TYPES))
 # ------------------------------------------------------
 
 # ------------------------------------------------------
@@ -197,10 +585,31 @@ CACHE_DEFAULT_TIMEOUT = get_env("CACHE_DEFAULT_TIMEOUT", default=60 * 60 * 24, c
 # ------------------------------------------------------
 class CeleryConfig:
     BROKER_URL = get_db_or_broker_uri("CELERY_BROKER", BROKER_PREFIXES, BROKER_DEFAULT_PORTS)
-    CELERY_IMPORTS = ("superset.sql_lab", "superset.tasks")
-    CELERY_RESULT_BACKEND = CELERY_RESULT_BACKENDS_URIS.get(get_env("CELERY_RESULT_BACKEND_TYPE", default="null"), "")
+    CELERY_IMPORTS = ("superset.sql_lab", "superset.tasks", "superset_docker.cache_warmup",
+                      "superset_docker.table_metadata")
+    CELERY_RESULT_BACKEND = CELERY_RESULT_BACKENDS_URIS.get(
+        get_env("CELERY_RESULT_BACKEND_TYPE", default="null", choices=["null"] + list(CELERY_RESULT_BACKENDS_URIS)),
+        lambda: ""
+    )()
     CELERYD_LOG_LEVEL = get_env("CELERYD_LOG_LEVEL", default="DEBUG")
     CELERY_ACKS_LATE = get_env("CELERY_ACKS_LATE", default=False, cast=bool)
+    CELERY_REDIS_MAX_CONNECTIONS = REDIS_POOL_OPTIONS["max_connections"]
+    CELERY_REDIS_SOCKET_TIMEOUT = REDIS_POOL_OPTIONS["socket_timeout"]
+    CELERY_REDIS_SOCKET_CONNECT_TIMEOUT = REDIS_POOL_OPTIONS["socket_connect_timeout"]
+    CELERY_REDIS_SOCKET_KEEPALIVE = REDIS_POOL_OPTIONS["socket_keepalive"]
+    CELERY_REDIS_BACKEND_HEALTH_CHECK_INTERVAL = REDIS_POOL_OPTIONS["health_check_interval"]
+    CELERY_RESULT_BACKEND_TRANSPORT_OPTIONS = {"master_name": REDIS_POOL_OPTIONS["sentinel_master"]} \
+        if REDIS_POOL_OPTIONS["mode"] == "sentinel" else {}
+    # Celery cache backend builds its pylibmc client with these options
+    CELERY_CACHE_BACKEND_OPTIONS = {
+        "binary": MEMCACHED_CLIENT_OPTIONS["binary"],
+        "behaviors": get_memcached_behaviors(
+            hashing="ketama",
+            **{option: value for option, value in MEMCACHED_CLIENT_OPTIONS.items()
+               if option not in ("binary", "pool_size")}
+        )
+    } if get_env("CELERY_MEMCACHED_RESULT_BACKEND_HASHING", default="modula", choices=MEMCACHED_HASHINGS) == "ketama" \
+        else {}
     CELERY_ANNOTATIONS = {
         "sql_lab.get_sql_results": {
             "rate_limit": get_env("CELERY_SQLLAB_GET_RESULTS_RATE_LIMIT", default="100/s")
@@ -210,9 +619,20 @@ class CeleryConfig:
             "time_limit": get_env("CELERY_EMAIL_REPORTS_TIME_LIMIT", default=120, cast=int),
             "soft_time_limit": get_env("CELERY_EMAIL_REPORTS_SOFT_TIME_LIMIT", default=150, cast=int),
             "ignore_result": get_env("CELERY_EMAIL_REPORTS_IGNORE_RESULT", default=True, cast=bool)
+        },
+        # Shaped by EMAIL_REPORTS_SEND_RATE per message instead of a Celery rate limit per task
+        "email_reports.send_batch": {
+            "time_limit": get_env("CELERY_EMAIL_REPORTS_BATCH_TIME_LIMIT", default=1800, cast=int),
+            "soft_time_limit": get_env("CELERY_EMAIL_REPORTS_BATCH_SOFT_TIME_LIMIT", default=1700, cast=int),
+            "ignore_result": get_env("CELERY_EMAIL_REPORTS_IGNORE_RESULT", default=True, cast=bool)
         }
     }
     CELERY_BEAT_SCHEDULE = get_celery_beat_schedule()
+    CELERY_DEFAULT_QUEUE = get_env("CELERY_DEFAULT_QUEUE", default="celery")
+    CELERY_ROUTES = get_celery_routes()
+    CELERY_QUEUES = tuple(
+        Queue(queue) for queue in sorted({CELERY_DEFAULT_QUEUE} | {route["queue"] for route in CELERY_ROUTES.values()})
+    )
 
 
 CELERY_CONFIG = CeleryConfig
@@ -342,6 +762,10 @@ FEATURE_FLAGS = {
 FILTER_SELECT_ROW_LIMIT = get_env("FILTER_SELECT_ROW_LIMIT", default=10000, cast=int)
 # ------------------------------------------------------
 
+# ------------------------------------------------------
+FLASK_APP_MUTATOR = flask_app_mutator
+# ------------------------------------------------------
+
 # ------------------------------------------------------
 FLASK_USE_RELOAD = get_env("FLASK_USE_RELOAD", default=True, cast=bool)
 # ------------------------------------------------------
@@ -393,7 +817,9 @@ PUBLIC_ROLE_LIKE_GAMMA = get_env("PUBLIC_ROLE_LIKE_GAMMA", default=False, cast=b
 # ------------------------------------------------------
 
 # ------------------------------------------------------
-RESULTS_BACKEND = SUPERSET_RESULTS_BACKENDS.get(get_env("SUPERSET_RESULTS_BACKEND_TYPE", default="null"), lambda: None)()
+RESULTS_BACKEND = instrument_results_backend(serialize_results_backend(get_results_backend(
+    get_env("SUPERSET_RESULTS_BACKEND_TYPE", default="null", choices=["null"] + list(SUPERSET_RESULTS_BACKENDS))
+)))
 RESULTS_BACKEND_USE_MSGPACK = get_env("SUPERSET_RESULTS_BACKEND_USE_MSGPACK", default=True, cast=bool)
 # ------------------------------------------------------
 
@@ -458,7 +884,8 @@ SSL_CERT_PATH = get_env("SSL_CERT_PATH")
 # ------------------------------------------------------
 
 # ------------------------------------------------------
-STATS_LOGGER = STATS_LOGGERS.get(get_env("STATS_LOGGER_TYPE", default="dummy"), STATS_LOGGERS["dummy"])()
+STATS_LOGGER = STATS_LOGGERS.get(get_env("STATS_LOGGER_TYPE", default="dummy", choices=STATS_LOGGERS),
+                                 STATS_LOGGERS["dummy"])()
 # ------------------------------------------------------
 
 # ------------------------------------------------------
@@ -485,7 +912,14 @@ SQL_MAX_ROW = get_env("SQL_MAX_ROW", default=100000, cast=int)
 # ------------------------------------------------------
 SQLALCHEMY_TRACK_MODIFICATIONS = get_env("SQLALCHEMY_TRACK_MODIFICATIONS", default=False, cast=bool)
 SQLALCHEMY_DATABASE_URI = get_db_or_broker_uri("METADATA_DB", METADATA_DB_PREFIXES, METADATA_DB_DEFAULT_PORTS)
-SQLALCHEMY_EXAMPLES_URI = get_db_or_broker_uri("METADATA_DB", METADATA_DB_PREFIXES, METADATA_DB_DEFAULT_PORTS)
+SQLALCHEMY_EXAMPLES_URI = SQLALCHEMY_DATABASE_URI
+SQLALCHEMY_ENGINE_OPTIONS = get_sqlalchemy_engine_options("METADATA_DB")
+SQLALCHEMY_BINDS = {
+    "metadata_replica": get_db_or_broker_uri("METADATA_DB",
+                                             METADATA_DB_PREFIXES,
+                                             METADATA_DB_DEFAULT_PORTS,
+                                             host_env_var_prefix="METADATA_DB_REPLICA")
+} if get_env("METADATA_DB_REPLICA_HOST") else {}
 # ------------------------------------------------------
 
 # ------------------------------------------------------
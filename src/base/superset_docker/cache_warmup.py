@@ -0,0 +1,160 @@
+# Adaptive cache warm-up: refreshes charts of frequently accessed dashboards shortly before their cache expires
+# -------------------------------------------------
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from time import time
+from urllib import request
+from sqlalchemy import func
+from superset import app, cache, db
+from superset.extensions import celery_app
+from superset.models.core import Log
+from superset.models.dashboard import Dashboard
+
+logger = logging.getLogger(__name__)
+
+WARMED_AT_KEY = "adaptive_cache_warmup:warmed_at:{}"
+IN_FLIGHT_KEY = "adaptive_cache_warmup:in_flight:{}"
+
+
+def get_chart_backend(chart):
+    """Returns database of table charts or cluster of Druid ones, which both have an id and a cache timeout."""
+    datasource = chart.datasource
+
+    return datasource.cluster if datasource.type == "druid" else datasource.database
+
+
+def get_chart_cache_timeout(chart):
+    return (chart.cache_timeout or
+            chart.datasource.cache_timeout or
+            get_chart_backend(chart).cache_timeout or
+            app.config["CACHE_DEFAULT_TIMEOUT"])
+
+
+def get_chart_data_key(chart):
+    """Returns cache key of chart data as computed by its viz, None when it cannot be computed outside a request."""
+    try:
+        viz_obj = chart.viz
+
+        return viz_obj.cache_key(viz_obj.query_obj())
+    except Exception:
+        logger.debug("Data cache key of chart %s could not be computed", chart.id, exc_info=True)
+        return None
+
+
+def get_dashboard_access_counts(since, top_n, min_access_count):
+    return db.session.query(Log.dashboard_id, func.count(Log.id).label("access_count")) \
+                     .filter(Log.dashboard_id.isnot(None), Log.dttm >= since) \
+                     .group_by(Log.dashboard_id) \
+                     .having(func.count(Log.id) >= min_access_count) \
+                     .order_by(func.count(Log.id).desc()) \
+                     .limit(top_n) \
+                     .all()
+
+
+def get_warmup_candidates(access_counts, refresh_before_expiry_ratio):
+    """Returns (remaining_ttl, -access_count, chart) of charts whose cache is about to expire."""
+    dashboards = db.session.query(Dashboard).filter(Dashboard.id.in_([row[0] for row in access_counts])).all()
+    access_count_by_dashboard = dict(access_counts)
+    charts = {}
+    access_count_by_chart = defaultdict(int)
+
+    for dashboard in dashboards:
+        for chart in dashboard.slices:
+            if chart.datasource is None:
+                continue
+
+            charts[chart.id] = chart
+            access_count_by_chart[chart.id] += access_count_by_dashboard[dashboard.id]
+
+    chart_ids = list(charts)
+    warmed_ats = cache.get_many(*[WARMED_AT_KEY.format(chart_id) for chart_id in chart_ids]) if chart_ids else []
+    now = time()
+    candidates = []
+
+    for chart_id, warmed_at in zip(chart_ids, warmed_ats):
+        chart = charts[chart_id]
+
+        try:
+            cache_timeout = get_chart_cache_timeout(chart)
+        except Exception:
+            logger.exception("Cache timeout of chart %s could not be resolved, skipping", chart_id)
+            continue
+
+        remaining_ttl = max(warmed_at + cache_timeout - now, 0) if warmed_at else 0
+        data_key = get_chart_data_key(chart)
+
+        # Cached data decides, the marker only estimates its age: data evicted early is warmed up first, data cached by
+        # user requests rather than a warm-up is left alone
+        if data_key is not None:
+            if not cache.has(data_key):
+                remaining_ttl = 0
+            elif not warmed_at:
+                continue
+
+        if remaining_ttl > cache_timeout * refresh_before_expiry_ratio:
+            continue
+
+        candidates.append((remaining_ttl, -access_count_by_chart[chart_id], chart))
+
+    return sorted(candidates, key=lambda candidate: candidate[:2])
+
+
+def get_warmup_url(chart):
+    return "{SUPERSET_WEBSERVER_PROTOCOL}://{SUPERSET_WEBSERVER_ADDRESS}:{SUPERSET_WEBSERVER_PORT}".format(
+        **app.config
+    ) + "/superset/warm_up_cache/?slice_id={}".format(chart.id)
+
+
+@celery_app.task(name="adaptive-cache-warmup-chart", soft_time_limit=300)
+def warmup_chart(chart_id, url, cache_timeout):
+    try:
+        logger.info("Warming up chart %s cache (url: %s)", chart_id, url)
+        request.urlopen(url)
+        cache.set(WARMED_AT_KEY.format(chart_id), time(), timeout=cache_timeout)
+    except Exception:
+        logger.exception("Chart %s cache warm-up failed", chart_id)
+    finally:
+        cache.delete(IN_FLIGHT_KEY.format(chart_id))
+
+
+@celery_app.task(name="adaptive-cache-warmup", soft_time_limit=300)
+def schedule_warmups(since_in_hours=24, top_n=20, min_access_count=1, refresh_before_expiry_ratio=0.2,
+                     max_concurrency_per_database=2, max_warmups_per_run=50, in_flight_timeout=600):
+    access_counts = get_dashboard_access_counts(since=datetime.utcnow() - timedelta(hours=since_in_hours),
+                                                top_n=top_n,
+                                                min_access_count=min_access_count)
+
+    if not access_counts:
+        return []
+
+    candidates = get_warmup_candidates(access_counts, refresh_before_expiry_ratio)
+    in_flight_markers = cache.get_many(*[IN_FLIGHT_KEY.format(chart.id) for _, _, chart in candidates]) \
+        if candidates else []
+    in_flight_by_database = defaultdict(int)
+
+    # In-flight markers store the database (or Druid cluster) key, running warm-ups count against the per-database cap
+    for database_id in in_flight_markers:
+        if database_id is not None:
+            in_flight_by_database[database_id] += 1
+
+    dispatched = []
+
+    for (_, _, chart), in_flight_marker in zip(candidates, in_flight_markers):
+        # Ids of databases and Druid clusters may collide, so keys carry the datasource type
+        database_id = "{}:{}".format(chart.datasource.type, get_chart_backend(chart).id)
+
+        if len(dispatched) >= max_warmups_per_run:
+            break
+        elif in_flight_marker is not None or in_flight_by_database[database_id] >= max_concurrency_per_database:
+            continue
+        elif not cache.add(IN_FLIGHT_KEY.format(chart.id), database_id, timeout=in_flight_timeout):
+            continue
+
+        warmup_chart.delay(chart.id, get_warmup_url(chart), get_chart_cache_timeout(chart))
+        in_flight_by_database[database_id] += 1
+        dispatched.append(chart.id)
+
+    logger.info("Dispatched %s adaptive cache warm-ups: %s", len(dispatched), dispatched)
+
+    return dispatched
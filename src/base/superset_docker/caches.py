@@ -0,0 +1,572 @@
+# Cache backends used by superset_config.py in addition to the ones shipped with cachelib
+# -------------------------------------------------
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from time import time
+from cachelib import BaseCache
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+def get_payload_size(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    elif isinstance(value, str):
+        return len(value.encode("utf-8"))
+
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+class LRUMemoryCache(BaseCache):
+    """In-process cache bounded by the total size of its values in bytes, evicting least recently used entries."""
+
+    def __init__(self, max_size=64 * 1024 * 1024, default_timeout=60):
+        super().__init__(default_timeout=default_timeout)
+        self._max_size = max_size
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _normalize_timeout(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        return time() + timeout if timeout > 0 else 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            self._size -= entry[2]
+
+        return entry is not None
+
+    def _evict(self):
+        while self._size > self._max_size and self._entries:
+            _, (_, _, size) = self._entries.popitem(last=False)
+            self._size -= size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            expires, value, _ = entry
+
+            if expires != 0 and expires <= time():
+                self._remove(key)
+                return None
+
+            self._entries.move_to_end(key)
+
+            return value
+
+    def set(self, key, value, timeout=None):
+        size = get_payload_size(value)
+
+        with self._lock:
+            self._remove(key)
+
+            # Values bigger than the whole cache are never kept locally
+            if size > self._max_size:
+                return False
+
+            self._entries[key] = (self._normalize_timeout(timeout), value, size)
+            self._size += size
+            self._evict()
+
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._remove(key)
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+        return True
+
+
+class DiskCache(BaseCache):
+    """Cache on local disk shared by every process of the host, read through mmap and bounded by total file size.
+
+    Files are sharded by key hash and written atomically (temporary file + rename). A sweeper thread removes expired
+    files and evicts least recently read ones above max_size, a lock file lets one process of the host sweep at a time.
+    """
+
+    HEADER = struct.Struct(">dc")
+    VALUE_BYTES = b"B"
+    VALUE_PICKLE = b"P"
+
+    def __init__(self, cache_dir, max_size=10 * 1024 * 1024 * 1024, default_timeout=300, sweep_interval=60,
+                 low_watermark=0.9):
+        super().__init__(default_timeout=default_timeout)
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self.low_watermark = low_watermark
+        self._sweeper_pid = None
+        self._sweeper_lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _normalize_timeout(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+
+        return time() + timeout if timeout > 0 else 0
+
+    def _get_path(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+        return os.path.join(self.cache_dir, digest[:2], digest[2:4], digest)
+
+    def _iter_paths(self, temporary=False):
+        for root, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                # Temporary files of writes in progress (or of crashed writers) and the sweep lock start with a dot
+                if filename.startswith(".") == temporary and root != self.cache_dir:
+                    yield os.path.join(root, filename)
+
+    def _ensure_sweeper(self):
+        # Threads do not survive fork, every gunicorn worker and Celery child starts its own
+        if self.sweep_interval <= 0 or self._sweeper_pid == os.getpid():
+            return
+
+        with self._sweeper_lock:
+            if self._sweeper_pid != os.getpid():
+                self._sweeper_pid = os.getpid()
+                threading.Thread(target=self._sweep_forever, daemon=True).start()
+
+    def _sweep_forever(self):
+        stop = threading.Event()
+
+        while not stop.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Sweeping disk cache \"%s\" failed", self.cache_dir)
+
+    def sweep(self):
+        """Removes expired files and evicts least recently read ones until total size is below low watermark."""
+        with open(os.path.join(self.cache_dir, ".sweep.lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+
+            now = time()
+            entries = []
+
+            for path in self._iter_paths():
+                try:
+                    with open(path, "rb") as entry_file:
+                        expires, _ = self.HEADER.unpack(entry_file.read(self.HEADER.size))
+
+                    if expires != 0 and expires <= now:
+                        os.remove(path)
+                    else:
+                        stat = os.stat(path)
+                        entries.append((stat.st_atime, stat.st_size, path))
+                except (OSError, struct.error):
+                    continue
+
+            for path in self._iter_paths(temporary=True):
+                try:
+                    if os.stat(path).st_mtime < now - 3600:
+                        os.remove(path)
+                except OSError:
+                    continue
+
+            total_size = sum(size for _, size, _ in entries)
+
+            if total_size <= self.max_size:
+                return
+
+            for _, size, path in sorted(entries):
+                if total_size <= self.max_size * self.low_watermark:
+                    break
+
+                try:
+                    os.remove(path)
+                    total_size -= size
+                except OSError:
+                    continue
+
+    def _remove_if_expired(self, path):
+        """Removes entry file if expired (or truncated), racing callers remove it once and never a fresh replacement."""
+        try:
+            with open(path, "rb") as entry_file:
+                fcntl.flock(entry_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+                # Path may have been replaced by a fresh entry since it was opened
+                if os.stat(path).st_ino != os.fstat(entry_file.fileno()).st_ino:
+                    return False
+
+                header = entry_file.read(self.HEADER.size)
+
+                if len(header) == self.HEADER.size:
+                    expires, _ = self.HEADER.unpack(header)
+
+                    if expires == 0 or expires > time():
+                        return False
+
+                os.remove(path)
+        except OSError:
+            return False
+
+        return True
+
+    def _map(self, key):
+        """Returns (value type, memoryview of value) of a live entry mapped read-only, None otherwise."""
+        path = self._get_path(key)
+
+        try:
+            with open(path, "rb") as entry_file:
+                mapped = mmap.mmap(entry_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            return None
+        except ValueError:
+            # Empty file
+            self._remove_if_expired(path)
+            return None
+
+        try:
+            expires, value_type = self.HEADER.unpack(mapped[:self.HEADER.size])
+        except struct.error:
+            # Truncated file, e.g. written on a full disk
+            expires, value_type = -1, None
+
+        if expires != 0 and expires <= time():
+            mapped.close()
+            self._remove_if_expired(path)
+            return None
+
+        # Access time drives LRU eviction, it is updated explicitly since disks are usually mounted with relatime
+        try:
+            os.utime(path, (time(), os.stat(path).st_mtime))
+        except OSError:
+            pass
+
+        return value_type, memoryview(mapped)[self.HEADER.size:]
+
+    def get_buffer(self, key):
+        """Returns bytes values as a zero-copy memoryview over the mapped file."""
+        entry = self._map(key)
+
+        if entry is None:
+            return None
+
+        value_type, data = entry
+
+        return data if value_type == self.VALUE_BYTES else pickle.loads(data)
+
+    def get(self, key):
+        entry = self._map(key)
+
+        if entry is None:
+            return None
+
+        value_type, data = entry
+
+        return bytes(data) if value_type == self.VALUE_BYTES else pickle.loads(data)
+
+    def _write(self, key, value, timeout, overwrite):
+        self._ensure_sweeper()
+
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value_type, data = self.VALUE_BYTES, value
+        else:
+            value_type, data = self.VALUE_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".", dir=os.path.dirname(path))
+
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                tmp_file.write(self.HEADER.pack(self._normalize_timeout(timeout), value_type))
+                tmp_file.write(data)
+
+            # Readers see either the previous file or the complete new one, never a partial write
+            if overwrite:
+                os.replace(tmp_path, path)
+            else:
+                os.link(tmp_path, path)
+        except FileExistsError:
+            return False
+        except OSError:
+            logger.exception("Writing \"%s\" to disk cache failed", key)
+            return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        return True
+
+    def set(self, key, value, timeout=None):
+        return self._write(key, value, timeout, overwrite=True)
+
+    def add(self, key, value, timeout=None):
+        # Expired entry must not block add. Linking fails on any existing file, so of concurrent adds only one wins
+        self._remove_if_expired(self._get_path(key))
+
+        return self._write(key, value, timeout, overwrite=False)
+
+    def delete(self, key):
+        try:
+            os.remove(self._get_path(key))
+        except OSError:
+            return False
+
+        return True
+
+    def has(self, key):
+        return self._map(key) is not None
+
+    def clear(self):
+        for path in self._iter_paths():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        return True
+
+
+COMPRESSION_CODECS = {
+    "none": (lambda data, level: data, lambda data: data),
+    "zlib": (lambda data, level: zlib.compress(data, level if level is not None else 6), zlib.decompress)
+}
+
+if zstandard:
+    COMPRESSION_CODECS["zstd"] = (
+        lambda data, level: zstandard.ZstdCompressor(level=level if level is not None else 3).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data)
+    )
+
+if lz4:
+    COMPRESSION_CODECS["lz4"] = (
+        lambda data, level: lz4.frame.compress(data, compression_level=level if level is not None else 0),
+        lz4.frame.decompress
+    )
+
+
+class TieredCache(BaseCache):
+    """Two-tier cache: a local cache in front of a remote one with write-through and read-promotion."""
+
+    def __init__(self, local, remote, local_timeout=None):
+        super().__init__(default_timeout=remote.default_timeout)
+        self.local = local
+        self.remote = remote
+        self.local_timeout = local.default_timeout if local_timeout is None else local_timeout
+
+    def _get_local_timeout(self, timeout):
+        if timeout is None or timeout <= 0:
+            return self.local_timeout
+
+        return min(timeout, self.local_timeout) if self.local_timeout > 0 else timeout
+
+    def get(self, key):
+        value = self.local.get(key)
+
+        if value is None:
+            value = self.remote.get(key)
+
+            if value is not None:
+                self.local.set(key, value, timeout=self._get_local_timeout(None))
+
+        return value
+
+    def set(self, key, value, timeout=None):
+        result = self.remote.set(key, value, timeout=timeout)
+
+        if result:
+            self.local.set(key, value, timeout=self._get_local_timeout(timeout))
+        else:
+            self.local.delete(key)
+
+        return result
+
+    def add(self, key, value, timeout=None):
+        result = self.remote.add(key, value, timeout=timeout)
+
+        if result:
+            self.local.set(key, value, timeout=self._get_local_timeout(timeout))
+
+        return result
+
+    def delete(self, key):
+        self.local.delete(key)
+
+        return self.remote.delete(key)
+
+    def has(self, key):
+        return self.local.has(key) or self.remote.has(key)
+
+    def clear(self):
+        self.local.clear()
+
+        return self.remote.clear()
+
+
+class CompressedCache(BaseCache):
+    """Wraps a cache, compressing payloads and splitting big ones into chunks stored under derived keys."""
+
+    HEADER_SINGLE = b"\x00S"
+    HEADER_CHUNKED = b"\x00C"
+    VALUE_BYTES = b"B"
+    VALUE_PICKLE = b"P"
+
+    def __init__(self, cache, codec="zlib", level=None, chunk_size=0):
+        if codec not in COMPRESSION_CODECS:
+            raise Exception("Wrong or unavailable compression codec \"{}\"".format(codec))
+
+        super().__init__(default_timeout=cache.default_timeout)
+        self.cache = cache
+        self.codec = codec
+        self.level = level
+        self.chunk_size = chunk_size
+        self._compress = COMPRESSION_CODECS[codec][0]
+        self._codec_id = codec.encode("ascii").ljust(4)
+
+    # Key is used as hash tag so every chunk of a payload lives on the same Redis Cluster slot
+    @staticmethod
+    def _get_chunk_key(key, token, idx):
+        return "{{{}}}:chunk:{}:{}".format(key, token, idx)
+
+    def _encode(self, value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return self.VALUE_BYTES, bytes(value)
+
+        return self.VALUE_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _decode(self, value_type, data):
+        codec = COMPRESSION_CODECS.get(data[:4].decode("ascii").strip())
+
+        # Payload written by an instance configured with a codec this one cannot decode
+        if codec is None:
+            return None
+
+        data = codec[1](data[4:])
+
+        return data if value_type == self.VALUE_BYTES else pickle.loads(data)
+
+    def _get_stored_chunk_keys(self, key, stored):
+        """Returns keys of the chunks a stored value refers to, none unless it is a chunked manifest."""
+        if not isinstance(stored, bytes) or stored[:2] != self.HEADER_CHUNKED:
+            return []
+
+        token, count = stored[3:].decode("ascii").split(":")
+
+        return [self._get_chunk_key(key, token, idx) for idx in range(int(count))]
+
+    def _read_chunks(self, key, manifest):
+        token, count = manifest.decode("ascii").split(":")
+        chunks = self.cache.get_many(*[self._get_chunk_key(key, token, idx) for idx in range(int(count))])
+
+        if any(chunk is None for chunk in chunks):
+            return None
+
+        return b"".join(chunks)
+
+    def get(self, key):
+        stored = self.cache.get(key)
+
+        if not isinstance(stored, bytes) or len(stored) < 3:
+            return stored
+
+        header, value_type, data = stored[:2], stored[2:3], stored[3:]
+
+        if header == self.HEADER_CHUNKED:
+            data = self._read_chunks(key, data)
+
+            if data is None:
+                return None
+        elif header != self.HEADER_SINGLE:
+            return stored
+
+        return self._decode(value_type, data)
+
+    def set(self, key, value, timeout=None):
+        value_type, data = self._encode(value)
+        data = self._codec_id + self._compress(data, self.level)
+        # Chunks of the replaced value are orphaned by the new manifest, they are deleted once it is written
+        stale_chunk_keys = self._get_stored_chunk_keys(key, self.cache.get(key)) if self.chunk_size > 0 else []
+
+        if self.chunk_size <= 0 or len(data) <= self.chunk_size:
+            return self._replace(key, self.HEADER_SINGLE + value_type + data, timeout, stale_chunk_keys)
+
+        # Chunks are written under a fresh token so a concurrent reader never mixes chunks of two writes
+        token = uuid.uuid4().hex
+        chunks = [data[idx:idx + self.chunk_size] for idx in range(0, len(data), self.chunk_size)]
+
+        if not self.cache.set_many({self._get_chunk_key(key, token, idx): chunk for idx, chunk in enumerate(chunks)},
+                                   timeout=timeout):
+            return False
+
+        manifest = "{}:{}".format(token, len(chunks)).encode("ascii")
+
+        return self._replace(key, self.HEADER_CHUNKED + value_type + manifest, timeout, stale_chunk_keys)
+
+    def _replace(self, key, stored, timeout, stale_chunk_keys):
+        if not self.cache.set(key, stored, timeout=timeout):
+            return False
+
+        if stale_chunk_keys:
+            self.cache.delete_many(*stale_chunk_keys)
+
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.cache.has(key):
+            return False
+
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        chunk_keys = self._get_stored_chunk_keys(key, self.cache.get(key))
+
+        if chunk_keys:
+            self.cache.delete_many(*chunk_keys)
+
+        return self.cache.delete(key)
+
+    def has(self, key):
+        return self.cache.has(key)
+
+    def clear(self):
+        return self.cache.clear()
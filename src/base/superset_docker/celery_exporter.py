@@ -0,0 +1,125 @@
+# Prometheus exporter of Celery queue lengths and in-flight task ages, run as a sidecar of worker pods
+#
+# Queue lengths are read from the broker of CeleryConfig.BROKER_URL, in-flight tasks are tracked from worker events
+# (workers run with -E). Both feed the custom metrics autoscaling the worker deployment (k8s/autoscaling).
+#
+# Usage: python -m superset_docker.celery_exporter [--port 9808] [--interval 15]
+# -------------------------------------------------
+import argparse
+import logging
+import sys
+import threading
+from time import sleep, time
+from celery import Celery
+from prometheus_client import Gauge, start_http_server
+
+logger = logging.getLogger(__name__)
+
+QUEUE_LENGTH = Gauge("superset_celery_queue_length", "Messages waiting in Celery queue", ["queue"])
+QUEUE_CONSUMERS = Gauge("superset_celery_queue_consumers", "Consumers of Celery queue", ["queue"])
+INFLIGHT_TASKS = Gauge("superset_celery_inflight_tasks", "Tasks received by workers and not finished", ["queue"])
+OLDEST_INFLIGHT_TASK_AGE = Gauge("superset_celery_oldest_inflight_task_age_seconds",
+                                 "Age of the oldest task received by workers and not finished", ["queue"])
+BROKER_UP = Gauge("superset_celery_broker_up", "Whether the last broker poll succeeded")
+
+FINISHED_EVENTS = ["task-succeeded", "task-failed", "task-revoked", "task-rejected"]
+
+
+class InflightTasks:
+    """Tasks received by workers and not finished yet, keyed by task id."""
+
+    def __init__(self, routes, default_queue, max_task_age):
+        self.routes = routes
+        self.default_queue = default_queue
+        self.max_task_age = max_task_age
+        self.tasks = {}
+        self.lock = threading.Lock()
+
+    def on_event(self, event):
+        with self.lock:
+            if event["type"] == "task-received":
+                queue = self.routes.get(event.get("name"), {}).get("queue", self.default_queue)
+                self.tasks[event["uuid"]] = (queue, event.get("timestamp") or time(), event.get("hostname"))
+            elif event["type"] in FINISHED_EVENTS:
+                self.tasks.pop(event["uuid"], None)
+            elif event["type"] == "worker-offline":
+                # Tasks of a worker shut down (e.g. scaled in) are never reported finished
+                self.tasks = {uuid: task for uuid, task in self.tasks.items() if task[2] != event.get("hostname")}
+
+    def collect(self, queues):
+        now = time()
+
+        with self.lock:
+            # Tasks whose events were lost would otherwise hold the oldest age up forever
+            self.tasks = {uuid: task for uuid, task in self.tasks.items() if now - task[1] < self.max_task_age}
+            tasks = list(self.tasks.values())
+
+        for queue in queues:
+            received = [received_at for task_queue, received_at, _ in tasks if task_queue == queue]
+            INFLIGHT_TASKS.labels(queue=queue).set(len(received))
+            OLDEST_INFLIGHT_TASK_AGE.labels(queue=queue).set(now - min(received) if received else 0)
+
+
+def capture_events(app, inflight_tasks):
+    while True:
+        try:
+            with app.connection_for_read() as connection:
+                receiver = app.events.Receiver(connection, handlers={"*": inflight_tasks.on_event})
+                receiver.capture(limit=None, timeout=None, wakeup=True)
+        except Exception:
+            logger.exception("Celery events could not be captured, reconnecting")
+            sleep(5)
+
+
+def collect_queue_lengths(app, queues):
+    try:
+        with app.connection_for_read() as connection:
+            for queue in queues:
+                channel = connection.channel()
+
+                try:
+                    _, length, consumers = channel.queue_declare(queue=queue, passive=True)
+                except connection.channel_errors:
+                    # Redis drops emptied queues, RabbitMQ has no queue until a worker consumed it
+                    length, consumers = 0, 0
+                finally:
+                    channel.close()
+
+                QUEUE_LENGTH.labels(queue=queue).set(length)
+                QUEUE_CONSUMERS.labels(queue=queue).set(consumers)
+
+        BROKER_UP.set(1)
+    except Exception:
+        logger.exception("Celery queue lengths could not be read")
+        BROKER_UP.set(0)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Exports Celery queue lengths and in-flight task ages")
+    parser.add_argument("--port", type=int, default=9808)
+    parser.add_argument("--interval", type=float, default=15)
+    parser.add_argument("--max-task-age", type=float, default=21600,
+                        help="Seconds after which a task without finish event is no longer tracked")
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+
+    from superset_config import CeleryConfig
+
+    app = Celery()
+    app.config_from_object(CeleryConfig)
+    queues = [queue.name for queue in CeleryConfig.CELERY_QUEUES]
+    inflight_tasks = InflightTasks(CeleryConfig.CELERY_ROUTES, CeleryConfig.CELERY_DEFAULT_QUEUE, args.max_task_age)
+
+    threading.Thread(target=capture_events, args=(app, inflight_tasks), daemon=True).start()
+    start_http_server(args.port)
+    logger.info("Exporting Celery metrics of queues %s on port %s", queues, args.port)
+
+    while True:
+        collect_queue_lengths(app, queues)
+        inflight_tasks.collect(queues)
+        sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
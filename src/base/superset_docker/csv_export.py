@@ -0,0 +1,207 @@
+# Streaming CSV export of SQL Lab results
+#
+# Rows are read in batches from the Arrow table of the results backend payload or from a server-side cursor and
+# encoded incrementally, so neither a DataFrame, the records nor the whole CSV string of the result is held in memory.
+# -------------------------------------------------
+import csv
+import io
+import logging
+import uuid
+import zlib
+from contextlib import closing
+from urllib import parse
+import sqlparse
+from flask import Response, flash, redirect, request, stream_with_context
+
+logger = logging.getLogger(__name__)
+
+
+def get_streaming_cursor(engine, connection, batch_size):
+    """Returns a server-side cursor where driver supports one, rows are otherwise buffered by the driver."""
+    if engine.dialect.driver == "psycopg2":
+        cursor = connection.cursor(name="superset_csv_export_{}".format(uuid.uuid4().hex))
+        cursor.itersize = batch_size
+
+        return cursor
+
+    if engine.dialect.driver == "mysqldb":
+        from MySQLdb.cursors import SSCursor
+
+        return connection.cursor(SSCursor)
+
+    return connection.cursor()
+
+
+def iter_database_rows(database, sql, schema, batch_size, log_query=None):
+    """Runs sql like Database.get_df does, QUERY_LOGGER (log_query) included, yielding rows of last statement."""
+    statements = [str(statement).strip(" ;") for statement in sqlparse.parse(sql)]
+    engine = database.get_sqla_engine(schema=schema)
+
+    def execute(cursor, statement):
+        if log_query:
+            log_query(engine.url, statement, schema)
+
+        database.db_engine_spec.execute(cursor, statement)
+
+    with closing(engine.raw_connection()) as connection:
+        with closing(connection.cursor()) as cursor:
+            for statement in statements[:-1]:
+                execute(cursor, statement)
+                cursor.fetchall()
+
+        with closing(get_streaming_cursor(engine, connection, batch_size)) as cursor:
+            execute(cursor, statements[-1])
+            rows = cursor.fetchmany(batch_size)
+
+            # Description of psycopg2 named cursors is only available after first fetch
+            yield [column[0] for column in cursor.description]
+
+            while rows:
+                yield from rows
+
+                rows = cursor.fetchmany(batch_size)
+
+
+def iter_table_rows(columns, table, batch_size):
+    """Yields columns then rows of Arrow table, materializing Python values of one record batch at a time."""
+    yield columns
+
+    for batch in table.to_batches(max_chunksize=batch_size):
+        values = batch.to_pydict()
+
+        yield from zip(*[values.get(column, [None] * batch.num_rows) for column in columns])
+
+
+def iter_results_backend_rows(blob, query, use_msgpack, batch_size):
+    import msgpack
+    import pyarrow as pa
+    from superset.utils.core import zlib_decompress
+    from superset.views.core import _deserialize_results_payload
+
+    if use_msgpack:
+        # Data of msgpack payloads is a serialized Arrow table, read without building a DataFrame or records of it
+        payload = msgpack.loads(zlib_decompress(blob), raw=False)
+        table = pa.deserialize(payload.pop("data"))
+
+        return iter_table_rows([column["name"] for column in payload["columns"]], table, batch_size)
+
+    # JSON payloads can only be decoded whole
+    payload = _deserialize_results_payload(zlib_decompress(blob, decode=True), query, use_msgpack)
+    columns = [column["name"] for column in payload["columns"]]
+
+    return iter([columns] + [[record.get(column) for column in columns] for record in payload.pop("data")])
+
+
+def get_arrow_results_cache(cache):
+    """Returns ArrowResultsCache found among wrappers (e.g. instrumentation) of results backend, if any."""
+    from superset_docker.results_serialization import ArrowResultsCache
+
+    while cache is not None and not isinstance(cache, ArrowResultsCache):
+        cache = getattr(cache, "cache", None)
+
+    return cache
+
+
+def encode_csv(rows, batch_size, csv_export_options, compress):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=csv_export_options.get("sep", ","), lineterminator="\n")
+    encoding = csv_export_options.get("encoding", "utf-8")
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    def flush():
+        chunk = buffer.getvalue().encode(encoding)
+        buffer.seek(0)
+        buffer.truncate()
+
+        return compressor.compress(chunk) if compressor else chunk
+
+    for idx, row in enumerate(rows, start=1):
+        writer.writerow(row)
+
+        if idx % batch_size == 0:
+            yield flush()
+
+    yield flush()
+
+    if compressor:
+        yield compressor.flush()
+
+
+def install(batch_size, gzip):
+    """Replaces SQL Lab CSV download view (Superset.csv) with a streaming one, must run before views are registered."""
+    from flask_appbuilder import expose
+    from flask_appbuilder.security.decorators import has_access
+    from superset import app, db, event_logger, results_backend, security_manager
+    from superset.exceptions import SupersetSecurityException
+    from superset.models.sql_lab import Query
+    from superset.utils.core import get_username
+    from superset.views.core import Superset
+
+    config = app.config
+
+    def log_query(url, sql, schema):
+        if config["QUERY_LOGGER"]:
+            config["QUERY_LOGGER"](url, sql, schema, get_username(), __name__, security_manager)
+
+    def csv_view(self, client_id):
+        """Download the query results as csv."""
+        logger.info("Exporting CSV file [%s]", client_id)
+        query = db.session.query(Query).filter_by(client_id=client_id).one()
+
+        try:
+            security_manager.raise_for_access(query=query)
+        except SupersetSecurityException as ex:
+            flash(ex.error.message)
+            return redirect("/")
+
+        rows = None
+
+        if results_backend and query.results_key:
+            logger.info("Fetching CSV from results backend [%s]", query.results_key)
+            arrow_results_cache = get_arrow_results_cache(results_backend)
+            stored = arrow_results_cache.get_table(query.results_key) if arrow_results_cache else None
+
+            if stored is not None:
+                payload, table = stored
+                rows = iter_table_rows([column["name"] for column in payload["columns"]], table, batch_size)
+            else:
+                blob = results_backend.get(query.results_key)
+
+                if blob:
+                    rows = iter_results_backend_rows(blob, query, config["RESULTS_BACKEND_USE_MSGPACK"], batch_size)
+
+        if rows is None:
+            logger.info("Streaming query results as CSV")
+            rows = iter_database_rows(query.database, query.select_sql or query.executed_sql, query.schema,
+                                      batch_size, log_query=log_query)
+
+        compress = gzip and "gzip" in request.headers.get("Accept-Encoding", "")
+
+        def export():
+            row_count = -1  # header row
+
+            def count(rows):
+                nonlocal row_count
+
+                for row in rows:
+                    row_count += 1
+                    yield row
+
+            yield from encode_csv(count(rows), batch_size, config["CSV_EXPORT"], compress)
+
+            # Row count is only known once the stream is done
+            event_info = {"event_type": "data_export", "client_id": client_id, "row_count": max(row_count, 0)}
+            logger.info("CSV exported: %s", repr(event_info), extra={"superset_event": event_info})
+
+        response = Response(stream_with_context(export()), mimetype="text/csv")
+        response.headers["Content-Disposition"] = "attachment; filename=\"{}.csv\"".format(parse.quote(query.name))
+
+        if compress:
+            response.headers["Content-Encoding"] = "gzip"
+            response.headers["Vary"] = "Accept-Encoding"
+
+        return response
+
+    # has_access and log_this name the permission and logged action after the function, they stay can_csv and csv
+    csv_view.__name__ = "csv"
+    Superset.csv = has_access(expose("/csv/<client_id>")(event_logger.log_this(csv_view)))
@@ -0,0 +1,319 @@
+# Batched email report delivery over pooled SMTP connections shaped by a token bucket
+#
+# Hourly scheduling enqueues one "email_reports.send_batch" task per distinct (eta, dashboard/chart, format) instead
+# of one task per schedule, so each report is rendered once and fanned out to the recipients of every schedule using
+# it. Individually delivered recipients are grouped into messages addressed by envelope only, and messages go through
+# persistent SMTP connections (no connect/STARTTLS/login per email) at the rate of a token bucket shared via Redis.
+# -------------------------------------------------
+import logging
+import queue
+import smtplib
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate
+from time import monotonic, sleep, time
+
+logger = logging.getLogger(__name__)
+
+# Reserves tokens, letting the balance go negative, and returns seconds the caller waits for its reservation
+TOKEN_BUCKET_SCRIPT = """
+local rate, capacity, now, requested = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated_at")
+local tokens = tonumber(state[1]) or capacity
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate) - requested
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated_at", now)
+redis.call("EXPIRE", KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+return tostring(math.max(0, -tokens / rate))
+"""
+
+
+class TokenBucket:
+    """Token bucket shared by every worker through Redis, or local to the process without a client."""
+
+    def __init__(self, rate, capacity, client=None, key="superset_email_reports:token_bucket"):
+        self.rate = rate
+        self.capacity = capacity
+        self.client = client
+        self.key = key
+        self.script = client.register_script(TOKEN_BUCKET_SCRIPT) if client is not None else None
+        self.tokens = capacity
+        self.updated_at = monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve_locally(self, tokens):
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate) - tokens
+            self.updated_at = now
+
+            return max(0, -self.tokens / self.rate)
+
+    def acquire(self, tokens=1):
+        if self.rate <= 0:
+            return
+
+        try:
+            wait = float(self.script(keys=[self.key], args=[self.rate, self.capacity, time(), tokens])) \
+                if self.script is not None else self._reserve_locally(tokens)
+        except Exception:
+            logger.exception("Shared email rate limit is unavailable, shaping locally")
+            wait = self._reserve_locally(tokens)
+
+        if wait > 0:
+            sleep(wait)
+
+
+class SMTPConnectionPool:
+    """Persistent SMTP sessions reused across messages, replaced after max_messages or when found dead."""
+
+    def __init__(self, host, port, ssl=False, starttls=True, user=None, password=None, size=2, max_messages=100,
+                 idle_check_interval=30, timeout=30):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.starttls = starttls
+        self.user = user
+        self.password = password
+        self.max_messages = max_messages
+        self.idle_check_interval = idle_check_interval
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue()
+
+    def connect(self):
+        smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout) if self.ssl \
+            else smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+        if self.starttls:
+            smtp.starttls()
+
+        if self.user and self.password:
+            smtp.login(self.user, self.password)
+
+        return smtp
+
+    @staticmethod
+    def close(smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
+
+    def is_alive(self, smtp):
+        try:
+            return smtp.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+
+    @contextmanager
+    def connection(self):
+        with self.slots:
+            try:
+                smtp, sent, last_used = self.idle.get_nowait()
+
+                if monotonic() - last_used >= self.idle_check_interval and not self.is_alive(smtp):
+                    self.close(smtp)
+                    smtp, sent = self.connect(), 0
+            except queue.Empty:
+                smtp, sent = self.connect(), 0
+
+            try:
+                yield smtp
+            except smtplib.SMTPServerDisconnected:
+                self.close(smtp)
+                raise
+            except smtplib.SMTPException:
+                # Rejected message leaves the session usable
+                self.idle.put((smtp, sent, monotonic()))
+                raise
+            except Exception:
+                self.close(smtp)
+                raise
+
+            if sent + 1 >= self.max_messages:
+                self.close(smtp)
+            else:
+                self.idle.put((smtp, sent + 1, monotonic()))
+
+    def sendmail(self, from_addr, to_addrs, message):
+        try:
+            with self.connection() as smtp:
+                return smtp.sendmail(from_addr, to_addrs, message)
+        except smtplib.SMTPServerDisconnected:
+            # Servers drop idle sessions silently, the message is retried once over a fresh one
+            with self.connection() as smtp:
+                return smtp.sendmail(from_addr, to_addrs, message)
+
+
+def build_message(mail_from, to_header, subject, body, data=None, images=None):
+    msg = MIMEMultipart("related")
+    msg["Subject"] = subject
+    msg["From"] = mail_from
+    msg["To"] = to_header
+    msg["Date"] = formatdate(localtime=True)
+    msg.attach(MIMEText(body, "html"))
+
+    for filename, content in (data or {}).items():
+        msg.attach(MIMEApplication(content, Content_Disposition="attachment; filename=\"{}\"".format(filename),
+                                   Name=filename))
+
+    for msgid, content in (images or {}).items():
+        image = MIMEImage(content)
+        image.add_header("Content-ID", "<{}>".format(msgid))
+        image.add_header("Content-Disposition", "inline")
+        msg.attach(image)
+
+    return msg.as_string()
+
+
+class ReportMailer:
+    """Sends rendered reports, one message for a group or per max_recipients individually addressed recipients."""
+
+    def __init__(self, pool, bucket, mail_from, bcc=None, max_recipients=50, dryrun=False):
+        self.pool = pool
+        self.bucket = bucket
+        self.mail_from = mail_from
+        self.bcc = bcc or []
+        self.max_recipients = max_recipients
+        self.dryrun = dryrun
+
+    def send(self, recipients, subject, message):
+        if self.dryrun:
+            logger.info("Dry run, email report \"%s\" not sent to %s", subject, recipients)
+            return
+
+        self.bucket.acquire()
+        self.pool.sendmail(self.mail_from, recipients, message)
+        logger.info("Sent email report \"%s\" to %s", subject, recipients)
+
+    def deliver(self, recipients, deliver_as_group, subject, body, data, images):
+        if deliver_as_group:
+            self.send(recipients + self.bcc, subject,
+                      build_message(self.mail_from, ", ".join(recipients), subject, body, data, images))
+            return
+
+        # Recipients of individual delivery must not see each other, the message is rendered once and
+        # addressed to each group through the envelope only
+        message = build_message(self.mail_from, "undisclosed-recipients:;", subject, body, data, images)
+
+        for idx in range(0, len(recipients), self.max_recipients):
+            self.send(recipients[idx:idx + self.max_recipients] + self.bcc, subject, message)
+
+
+def get_render_key(report_type, schedule):
+    if report_type == "dashboard":
+        return report_type, schedule.dashboard_id, str(schedule.delivery_type), None
+
+    return report_type, schedule.slice_id, str(schedule.delivery_type), str(schedule.email_format)
+
+
+def install(mailer):
+    """Schedules dashboard and chart reports through the batched task, which is returned."""
+    from superset import db
+    from superset.extensions import celery_app
+    from superset.tasks import schedules
+    from superset.utils.core import get_email_address_list
+
+    capture = threading.local()
+    deliver_email = schedules._deliver_email
+    deliver_slack_msg = schedules.deliver_slack_msg
+    schedule_window = schedules.schedule_window
+
+    # Only renders of send_batch are captured, alerts and email_reports.send keep delivering through Superset
+    def capture_email(recipients, deliver_as_group, subject, body, data, images):
+        if getattr(capture, "content", None) is not None:
+            capture.content["email"] = (subject, body, data, images)
+            return
+
+        deliver_email(recipients, deliver_as_group, subject, body, data, images)
+
+    def capture_slack_msg(slack_channel, subject, body, file):
+        if getattr(capture, "content", None) is not None:
+            capture.content["slack"] = (subject, body, file)
+            return
+
+        deliver_slack_msg(slack_channel, subject, body, file)
+
+    def render(report_type, schedule):
+        """Runs Superset delivery of schedule with sending captured, returning rendered email and Slack content."""
+        capture.content = {}
+
+        try:
+            if report_type == "dashboard":
+                schedules.deliver_dashboard(schedule.dashboard_id, "capture", "capture", schedule.delivery_type,
+                                            True)
+            else:
+                schedules.deliver_slice(schedule.slice_id, "capture", "capture", schedule.delivery_type,
+                                        schedule.email_format, True)
+
+            return capture.content
+        finally:
+            capture.content = None
+
+    @celery_app.task(name="email_reports.send_batch")
+    def send_batch(report_type, schedule_ids):
+        """Renders each distinct report of schedules once and delivers it to every schedule."""
+        model_cls = schedules.get_scheduler_model(report_type)
+        dbsession = db.create_scoped_session()
+        batches = defaultdict(list)
+
+        try:
+            for schedule in dbsession.query(model_cls).filter(model_cls.id.in_(schedule_ids)):
+                if schedule.active:
+                    batches[get_render_key(report_type, schedule)].append(schedule)
+
+            for render_key, batch in batches.items():
+                content = render(report_type, batch[0])
+
+                for schedule in batch:
+                    try:
+                        if schedule.recipients and "email" in content:
+                            mailer.deliver(get_email_address_list(schedule.recipients), schedule.deliver_as_group,
+                                           *content["email"])
+
+                        if schedule.slack_channel and "slack" in content:
+                            deliver_slack_msg(schedule.slack_channel, *content["slack"])
+                    except Exception:
+                        logger.exception("Report %s could not be delivered for schedule %s", render_key, schedule.id)
+        finally:
+            dbsession.remove()
+
+    def batched_schedule_window(report_type, start_at, stop_at, resolution):
+        if report_type not in ("dashboard", "slice"):
+            return schedule_window(report_type, start_at, stop_at, resolution)
+
+        # ScheduleType is a str enum, its value is what goes through the broker
+        report_type = getattr(report_type, "value", report_type)
+
+        model_cls = schedules.get_scheduler_model(report_type)
+        dbsession = db.create_scoped_session()
+        batches = defaultdict(list)
+
+        try:
+            for schedule in dbsession.query(model_cls).filter(model_cls.active.is_(True)):
+                # Like Superset's schedule_window, a schedule is sent at most once per window
+                eta = next(iter(schedules.next_schedules(schedule.crontab, start_at, stop_at, resolution=resolution)),
+                           None)
+
+                if eta is not None:
+                    batches[(eta,) + get_render_key(report_type, schedule)].append(schedule.id)
+        finally:
+            dbsession.remove()
+
+        for (eta, *render_key), schedule_ids in batches.items():
+            logger.info("Scheduling report %s at %s for schedules %s", render_key, eta, schedule_ids)
+            send_batch.apply_async((report_type, schedule_ids), eta=eta)
+
+        return None
+
+    schedules._deliver_email = capture_email
+    schedules.deliver_slack_msg = capture_slack_msg
+    schedules.schedule_window = batched_schedule_window
+
+    return send_batch
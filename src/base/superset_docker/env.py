@@ -0,0 +1,194 @@
+# Typed environment variables shared by superset_config.py and gunicorn_config.py
+#
+# Every get_env call declares its variable (type, default and valid values) in ENV_VARS. Raw environment is read and
+# cast once per process, invalid values fail fast with an explicit message. Check and dump modes also declare the
+# variables of get_env calls not run when configs are loaded (flask_app_mutator, unselected backends).
+#
+# Usage: python -m superset_docker.env [--check] [--dump]
+#   --check: loads configs, reports invalid values and unknown variables, exits with 1 on errors
+#   --dump: prints every declared variable with its type, default and resolved value as JSON
+# -------------------------------------------------
+import ast
+import importlib.util
+import json
+import sys
+from collections import namedtuple
+from os import environ
+from types import MappingProxyType
+
+ENV_VAR_TYPE_CASTER = {
+    int: lambda value: int(value),
+    float: lambda value: float(value),
+    bool: lambda value: str(value).lower() == "true",
+    list: lambda value: value.split(","),
+    str: lambda value: value
+}
+
+# Variables consumed by entrypoint.sh or the image itself rather than by Python configs
+EXTERNAL_ENV_VAR_PREFIXES = ("SUPERSET_DAEMONS", "SUPERSET_MAX_RETRY", "SUPERSET_RETRY", "SUPERSET_STARTUP",
+                             "SUPERSET_HEALTHCHECK", "SUPERSET_CONFIG", "SUPERSET_HOME", "SUPERSET_USER_HOME",
+                             "SUPERSET_VIRTUALENV", "GUNICORN_CONFIG_PATH", "CELERY_WORKER_", "CELERY_BROKER_POOL_TYPE",
+                             "CELERY_BROKER_CONCURRENCY", "ADMIN_", "LOAD_EXAMPLES",
+                             "PROMETHEUS_MULTIPROC_DIR")
+
+SECRET_ENV_VAR_MARKERS = ("PASSWORD", "SECRET", "API_KEY")
+
+EnvVar = namedtuple("EnvVar", ["name", "cast", "default", "choices"])
+
+ENV_VARS = {}
+ENV_VAR_ERRORS = []
+ENV_VAR_VALUES = {}
+
+# In check mode invalid values are collected instead of raised so all of them are reported at once
+CHECK_MODE = environ.get("SUPERSET_CONFIG_CHECK", "false").lower() == "true"
+
+
+def parse_env(env_var, cast, choices):
+    value = environ.get(env_var, None)
+
+    if not value:
+        return None
+
+    try:
+        value = ENV_VAR_TYPE_CASTER[cast](value)
+    except ValueError:
+        return report_error("Wrong value \"{}\" of \"{}\" (expected {})".format(value, env_var, cast.__name__))
+
+    invalid_values = [item for item in (value if cast is list else [value]) if choices and item not in choices]
+
+    if invalid_values:
+        return report_error("Wrong value \"{}\" of \"{}\" (valid values: {})".format(
+            ",".join(str(item) for item in invalid_values), env_var, ", ".join(sorted(str(item) for item in choices))
+        ))
+
+    return value
+
+
+def report_error(message):
+    if not CHECK_MODE:
+        raise Exception(message)
+
+    ENV_VAR_ERRORS.append(message)
+
+
+def get_env(env_var, default=None, cast: type = str, choices=None):
+    if env_var not in ENV_VARS:
+        ENV_VARS[env_var] = EnvVar(env_var, cast, default, tuple(choices) if choices else None)
+
+    key = (env_var, cast, frozenset(choices) if choices else None)
+
+    if key not in ENV_VAR_VALUES:
+        ENV_VAR_VALUES[key] = parse_env(env_var, cast, choices)
+
+    value = ENV_VAR_VALUES[key]
+
+    if value is None:
+        return default
+
+    return list(value) if cast is list else value
+
+
+def get_settings():
+    """Returns a read-only mapping of every declared variable to its resolved value."""
+    return MappingProxyType({
+        env_var.name: get_env(env_var.name, default=env_var.default, cast=env_var.cast, choices=env_var.choices)
+        for env_var in ENV_VARS.values()
+    })
+
+
+def get_unknown_env_vars():
+    declared_prefixes = {name.split("_")[0] for name in ENV_VARS}
+
+    return sorted(
+        name for name in environ
+        if name not in ENV_VARS and name.split("_")[0] in declared_prefixes and
+        not name.startswith(EXTERNAL_ENV_VAR_PREFIXES)
+    )
+
+
+def load_config(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def declare_env_vars(module, path):
+    """Declares (and validates) variables of every get_env call of config named by a literal, run or not."""
+    with open(path) as config_file:
+        tree = ast.parse(config_file.read(), path)
+
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Name) or node.func.id != "get_env" or \
+                not node.args:
+            continue
+
+        # String literals are ast.Str nodes before Python 3.8
+        env_var = getattr(node.args[0], "value", getattr(node.args[0], "s", None))
+
+        if not isinstance(env_var, str) or env_var in ENV_VARS:
+            continue
+
+        kwargs = {}
+
+        for keyword in node.keywords:
+            if keyword.arg is None:
+                continue
+
+            try:
+                kwargs[keyword.arg] = eval(compile(ast.Expression(keyword.value), path, "eval"), vars(module))
+            except Exception:
+                kwargs[keyword.arg] = None
+
+        # Variable is left to its get_env call when its type or valid values depend on local state
+        if "cast" in kwargs and kwargs["cast"] not in ENV_VAR_TYPE_CASTER or \
+                "choices" in kwargs and kwargs["choices"] is None:
+            continue
+
+        get_env(env_var, **kwargs)
+
+
+def dump():
+    settings = get_settings()
+
+    return json.dumps({
+        name: {
+            "type": env_var.cast.__name__,
+            "default": env_var.default,
+            "choices": env_var.choices,
+            "value": "******" if any(marker in name for marker in SECRET_ENV_VAR_MARKERS) and settings[name] else
+                     settings[name]
+        }
+        for name, env_var in sorted(ENV_VARS.items())
+    }, indent=2, default=str)
+
+
+def main(args):
+    for name, path_env_var in [("superset_config", "SUPERSET_CONFIG_PATH"), ("gunicorn_config", "GUNICORN_CONFIG_PATH")]:
+        if environ.get(path_env_var):
+            try:
+                declare_env_vars(load_config(name, environ[path_env_var]), environ[path_env_var])
+            except Exception as e:
+                ENV_VAR_ERRORS.append("Config \"{}\" cannot be loaded: {}".format(environ[path_env_var], e))
+
+    if "--dump" in args:
+        print(dump())
+
+    if "--check" in args:
+        for unknown_env_var in get_unknown_env_vars():
+            print("Unknown environment variable \"{}\"".format(unknown_env_var), file=sys.stderr)
+
+        for error in ENV_VAR_ERRORS:
+            print(error, file=sys.stderr)
+
+    return 1 if ENV_VAR_ERRORS else 0
+
+
+if __name__ == "__main__":
+    # Configs import superset_docker.env, so registry of that module (not of __main__) must be used
+    environ["SUPERSET_CONFIG_CHECK"] = "true"
+
+    from superset_docker import env
+
+    sys.exit(env.main(sys.argv[1:]))
@@ -0,0 +1,212 @@
+# Concurrent dependency health checks run by entrypoint.sh before starting Superset daemons
+#
+# Usage: python -m superset_docker.healthcheck <name>|<type>|<host>|<port>[|<credentials env var prefix>] ...
+# -------------------------------------------------
+import random
+import socket
+import sys
+import threading
+from datetime import datetime
+from os import environ
+from time import monotonic
+
+PROBE_TIMEOUT = float(environ.get("SUPERSET_HEALTHCHECK_PROBE_TIMEOUT_IN_SECS", 3))
+
+
+def log(message):
+    print("[{}] -> {}".format(datetime.now().strftime("%d/%m/%Y %H:%M:%S"), message), flush=True)
+
+
+def send_and_receive(host, port, request, response_size=64):
+    with socket.create_connection((host, port), timeout=PROBE_TIMEOUT) as connection:
+        connection.sendall(request)
+
+        return connection.recv(response_size)
+
+
+def probe_tcp(host, port, credentials_prefix):
+    socket.create_connection((host, port), timeout=PROBE_TIMEOUT).close()
+
+
+def probe_udp(host, port, credentials_prefix):
+    # Nothing answers a UDP datagram (e.g. statsd), so only check that the host is resolvable
+    socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_DGRAM)
+
+
+def probe_redis(host, port, credentials_prefix):
+    response = send_and_receive(host, port, b"PING\r\n")
+
+    # NOAUTH means server is up and serving but requires the password the client will send
+    if not (response.startswith(b"+PONG") or response.startswith(b"-NOAUTH")):
+        raise Exception("Unexpected Redis PING response {!r}".format(response))
+
+
+def probe_memcached(host, port, credentials_prefix):
+    response = send_and_receive(host, port, b"version\r\n")
+
+    if not response.startswith(b"VERSION"):
+        raise Exception("Unexpected memcached version response {!r}".format(response))
+
+
+def probe_rabbitmq(host, port, credentials_prefix):
+    response = send_and_receive(host, port, b"AMQP\x00\x00\x09\x01", response_size=8)
+
+    # Server answers protocol header with a Connection.Start method frame
+    if not response[:1] == b"\x01":
+        raise Exception("Unexpected AMQP handshake response {!r}".format(response))
+
+
+def get_credentials(credentials_prefix):
+    return {
+        "user": environ.get("{}_USERNAME".format(credentials_prefix)),
+        "password": environ.get("{}_PASSWORD".format(credentials_prefix)),
+        "database": environ.get("{}_DATABASE".format(credentials_prefix))
+    }
+
+
+def probe_postgresql(host, port, credentials_prefix):
+    import psycopg2
+
+    credentials = get_credentials(credentials_prefix)
+    connection = psycopg2.connect(host=host,
+                                  port=port,
+                                  user=credentials["user"],
+                                  password=credentials["password"],
+                                  dbname=credentials["database"],
+                                  connect_timeout=max(int(PROBE_TIMEOUT), 1))
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+    finally:
+        connection.close()
+
+
+def probe_mysql(host, port, credentials_prefix):
+    import MySQLdb
+
+    credentials = get_credentials(credentials_prefix)
+    connection = MySQLdb.connect(host=host,
+                                 port=int(port),
+                                 user=credentials["user"] or "",
+                                 passwd=credentials["password"] or "",
+                                 db=credentials["database"] or "",
+                                 connect_timeout=max(int(PROBE_TIMEOUT), 1))
+
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+    finally:
+        connection.close()
+
+
+PROBES = {
+    "redis": probe_redis,
+    "memcached": probe_memcached,
+    "rabbitmq": probe_rabbitmq,
+    "postgresql": probe_postgresql,
+    "mysql": probe_mysql,
+    "statsd": probe_udp
+}
+
+
+class HealthCheck:
+    def __init__(self, spec):
+        fields = spec.split("|")
+        self.name, self.type, self.host, self.port = fields[:4]
+        self.credentials_prefix = fields[4] if len(fields) > 4 else None
+        self.probe = PROBES.get(self.type, probe_tcp)
+        self.attempts = 0
+        self.elapsed = None
+        self.error = None
+        self.ready = False
+
+    def describe(self):
+        return "Superset {name} ({name}_type: \"{type}\", {name}_host: \"{host}\", {name}_port: \"{port}\")".format(
+            name=self.name, type=self.type, host=self.host, port=self.port
+        )
+
+    def run(self, stop, deadline, max_retry_times, base_interval, max_interval):
+        started = monotonic()
+
+        while not stop.is_set():
+            self.attempts += 1
+
+            try:
+                self.probe(self.host, self.port, self.credentials_prefix)
+                self.ready = True
+                self.elapsed = monotonic() - started
+                log("{} is ready after {} attempt(s) in {:.2f}s ✔".format(self.describe(), self.attempts,
+                                                                         self.elapsed))
+                return
+            except Exception as e:
+                self.error = e
+
+            if max_retry_times != -1 and self.attempts >= max_retry_times:
+                log("{} healthcheck failed: {}. Max retry times \"{}\" reached.".format(self.describe(), self.error,
+                                                                                      max_retry_times))
+                break
+
+            # Exponential backoff with full jitter spreads reconnects of containers scaled out together
+            interval = random.uniform(0, min(max_interval, base_interval * 2 ** (self.attempts - 1)))
+
+            if deadline is not None:
+                interval = min(interval, max(deadline - monotonic(), 0))
+
+                if interval <= 0:
+                    log("{} healthcheck failed: {}. Startup deadline reached.".format(self.describe(), self.error))
+                    break
+
+            log("Waiting {} is ready ({}). Retrying after {:.2f} seconds... (times: {}).".format(
+                self.describe(), self.error, interval, self.attempts
+            ))
+            stop.wait(interval)
+
+        self.elapsed = monotonic() - started
+        stop.set()
+
+
+def main(specs):
+    max_retry_times = int(environ.get("SUPERSET_MAX_RETRY_TIMES", -1))
+    base_interval = float(environ.get("SUPERSET_RETRY_INTERVAL_IN_SECS", 2))
+    max_interval = float(environ.get("SUPERSET_MAX_RETRY_INTERVAL_IN_SECS", 30))
+    deadline_in_secs = float(environ.get("SUPERSET_STARTUP_DEADLINE_IN_SECS", -1))
+    deadline = monotonic() + deadline_in_secs if deadline_in_secs > 0 else None
+    healthchecks = [HealthCheck(spec) for spec in specs]
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=healthcheck.run,
+                         args=(stop, deadline, max_retry_times, base_interval, max_interval),
+                         daemon=True)
+        for healthcheck in healthchecks
+    ]
+
+    for healthcheck in healthchecks:
+        log("{} healtcheck started...".format(healthcheck.describe()))
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    log("Healthcheck report:")
+
+    for healthcheck in healthchecks:
+        log("  {name:<24} {type:<12} {host}:{port:<8} {status:<8} attempts={attempts:<4} elapsed={elapsed:.2f}s".format(
+            name=healthcheck.name,
+            type=healthcheck.type,
+            host=healthcheck.host,
+            port=healthcheck.port,
+            status="ready" if healthcheck.ready else "failed",
+            attempts=healthcheck.attempts,
+            elapsed=healthcheck.elapsed or 0.0
+        ))
+
+    return 0 if all(healthcheck.ready for healthcheck in healthchecks) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
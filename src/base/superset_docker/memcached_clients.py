@@ -0,0 +1,66 @@
+# Shared memcached clients with ketama consistent hashing and automatic ejection of failing nodes
+#
+# Keys are placed on a ketama continuum, so adding or removing a node only remaps the keys of that node instead of
+# most of them. A node failing remove_failed times in a row is ejected and tried again after retry_timeout seconds.
+# -------------------------------------------------
+import threading
+import pylibmc
+
+MEMCACHED_CLIENTS = {}
+MEMCACHED_CLIENTS_LOCK = threading.Lock()
+
+
+def get_memcached_behaviors(hashing, remove_failed, retry_timeout, dead_timeout, connect_timeout, io_timeout):
+    behaviors = {
+        "tcp_nodelay": True,
+        "remove_failed": remove_failed,
+        "retry_timeout": retry_timeout,
+        "dead_timeout": dead_timeout,
+        # libmemcached expects connect timeout in milliseconds, send/receive timeouts in microseconds
+        "connect_timeout": int(connect_timeout * 1000),
+        "send_timeout": int(io_timeout * 1000000),
+        "receive_timeout": int(io_timeout * 1000000)
+    }
+
+    if hashing == "ketama":
+        behaviors["ketama"] = True
+
+    return behaviors
+
+
+class PooledMemcachedClient:
+    """pylibmc clients are not thread safe. Every call reserves one of a fixed set of clones, so connections and
+    node ejection state are kept across requests instead of living in a clone per thread (greenlet under gevent)."""
+
+    def __init__(self, client, size):
+        self._pool = pylibmc.ClientPool(client, size)
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            with self._pool.reserve(block=True) as client:
+                return getattr(client, name)(*args, **kwargs)
+
+        return call
+
+
+def get_memcached_client(servers, username=None, password=None, binary=True, hashing="ketama", remove_failed=3,
+                         retry_timeout=30, dead_timeout=60, connect_timeout=1.0, io_timeout=1.0, pool_size=8):
+    """Returns a client shared by every caller pointing to the same memcached servers."""
+    client_key = (tuple(server.strip() for server in servers), username, password, binary, hashing)
+
+    with MEMCACHED_CLIENTS_LOCK:
+        if client_key not in MEMCACHED_CLIENTS:
+            MEMCACHED_CLIENTS[client_key] = PooledMemcachedClient(pylibmc.Client(
+                list(client_key[0]),
+                binary=binary or bool(username),
+                username=username,
+                password=password,
+                behaviors=get_memcached_behaviors(hashing=hashing,
+                                                  remove_failed=remove_failed,
+                                                  retry_timeout=retry_timeout,
+                                                  dead_timeout=dead_timeout,
+                                                  connect_timeout=connect_timeout,
+                                                  io_timeout=io_timeout)
+            ), pool_size)
+
+        return MEMCACHED_CLIENTS[client_key]
@@ -0,0 +1,21 @@
+# Metadata database helpers used by superset_config.py
+# -------------------------------------------------
+from flask import has_request_context, request
+from flask_sqlalchemy import SignallingSession
+
+
+def route_reads_to_replica(app, db, bind_key, endpoints):
+    """Makes sessions of read-only requests to given endpoints query the replica bound with bind_key."""
+    replica_engine = db.get_engine(app, bind=bind_key)
+    endpoints = set(endpoints)
+    get_bind = SignallingSession.get_bind
+
+    def get_replica_or_primary_bind(self, mapper=None, clause=None):
+        # Flushes always go to primary so writes issued while serving a listing (e.g. event logs) are not lost
+        if (not self._flushing and has_request_context() and request.method == "GET" and
+                request.endpoint in endpoints):
+            return replica_engine
+
+        return get_bind(self, mapper=mapper, clause=clause)
+
+    SignallingSession.get_bind = get_replica_or_primary_bind
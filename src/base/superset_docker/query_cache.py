@@ -0,0 +1,187 @@
+# Warehouse query result cache keyed by normalized SQL, with single-flight execution and stale-while-revalidate
+# -------------------------------------------------
+import hashlib
+import logging
+import pickle
+import threading
+import uuid
+import zlib
+from time import monotonic, sleep, time
+from sqlparse import tokens as T
+from sqlparse.lexer import tokenize
+from flask import copy_current_request_context, has_request_context
+
+logger = logging.getLogger(__name__)
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+OVERSIZED = b"oversized"
+
+
+def normalize_sql(sql):
+    """Strips comments and trailing ";" and collapses whitespace between tokens. Other tokens, literals included, are
+    kept verbatim, so only queries differing in layout share a key."""
+    parts = []
+
+    for ttype, value in tokenize(sql):
+        if ttype in T.Comment or ttype in T.Whitespace:
+            if parts and parts[-1] != " ":
+                parts.append(" ")
+        else:
+            parts.append(value)
+
+    return "".join(parts).strip().rstrip(";").strip()
+
+
+class QueryResultCache:
+    def __init__(self, client, key_prefix, default_options, database_options, lock_timeout, wait_timeout,
+                 poll_interval):
+        self.client = client
+        self.key_prefix = key_prefix
+        self.default_options = default_options
+        self.database_options = database_options
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._release_lock = client.register_script(RELEASE_LOCK_SCRIPT)
+
+    def get_options(self, database):
+        options = dict(self.default_options)
+        options.update(self.database_options.get(database.database_name,
+                                                 self.database_options.get(str(database.id), {})))
+
+        return options
+
+    def get_key(self, database, schema, sql, username=None):
+        digest = hashlib.sha256("{}\n{}\n{}\n{}".format(database.id, schema or "", username or "", sql)
+                                .encode("utf-8")).hexdigest()
+
+        return "{}:{}".format(self.key_prefix, digest)
+
+    def acquire_lock(self, key):
+        token = uuid.uuid4().hex
+
+        if self.client.set(key + ":lock", token, nx=True, px=int(self.lock_timeout * 1000)):
+            return token
+
+        return None
+
+    def release_lock(self, key, token):
+        self._release_lock(keys=[key + ":lock"], args=[token])
+
+    def load(self, key):
+        payload = self.client.get(key)
+
+        if payload is None or payload == OVERSIZED:
+            return payload
+
+        return pickle.loads(zlib.decompress(payload))
+
+    def store(self, key, df, options):
+        payload = zlib.compress(pickle.dumps({"created_at": time(), "df": df}, pickle.HIGHEST_PROTOCOL))
+        expiry = int(options["ttl"] + options["stale_ttl"])
+
+        # Marker tells waiters to stop waiting and run the query themselves
+        if len(payload) > options["max_payload_size"]:
+            self.client.set(key, OVERSIZED, ex=max(int(options["ttl"]), 1))
+        else:
+            self.client.set(key, payload, ex=max(expiry, 1))
+
+    def execute_and_store(self, key, token, options, execute):
+        try:
+            df = execute()
+            self.store(key, df, options)
+
+            return df
+        finally:
+            self.release_lock(key, token)
+
+    def refresh_in_background(self, key, options, execute):
+        token = self.acquire_lock(key)
+
+        if token is None:
+            return
+
+        def refresh():
+            try:
+                self.execute_and_store(key, token, options, execute)
+            except Exception:
+                logger.exception("Background refresh of query result %s failed", key)
+
+        if has_request_context():
+            threading.Thread(target=copy_current_request_context(refresh), daemon=True).start()
+        else:
+            refresh()
+
+    def wait_for_result(self, key):
+        deadline = monotonic() + self.wait_timeout
+
+        while monotonic() < deadline:
+            entry = self.load(key)
+
+            if entry is not None or not self.client.exists(key + ":lock"):
+                return entry
+
+            sleep(self.poll_interval)
+
+        return None
+
+    def get_or_execute(self, database, schema, sql, execute):
+        from superset.utils.core import get_username
+
+        options = self.get_options(database)
+        normalized_sql = normalize_sql(sql)
+
+        if not options["enabled"] or not normalized_sql.lower().startswith(("select", "with")):
+            return execute()
+
+        # Databases impersonating users run the query as the current user, whose rows may differ from others'
+        key = self.get_key(database, schema, normalized_sql,
+                           username=get_username() if database.impersonate_user else None)
+        entry = self.load(key)
+
+        if entry is not None and entry != OVERSIZED:
+            if time() - entry["created_at"] < options["ttl"]:
+                return entry["df"]
+
+            # Background threads have no g.user, an impersonating database would run the refresh as its service user
+            # and store that user's rows under the impersonated user's key, so those are refreshed in the request
+            if not database.impersonate_user:
+                self.refresh_in_background(key, options, execute)
+
+                return entry["df"]
+        elif entry == OVERSIZED:
+            return execute()
+
+        token = self.acquire_lock(key)
+
+        if token is not None:
+            return self.execute_and_store(key, token, options, execute)
+
+        # Same query is running somewhere else, reuse its result instead of hitting the warehouse again
+        entry = self.wait_for_result(key)
+
+        return entry["df"] if entry is not None and entry != OVERSIZED else execute()
+
+
+def install(query_result_cache):
+    """Routes Database.get_df, used by chart data queries, through given query result cache."""
+    from superset.models.core import Database
+
+    get_df = Database.get_df
+
+    def get_cached_df(self, sql, schema=None, mutator=None):
+        df = query_result_cache.get_or_execute(self, schema, sql, lambda: get_df(self, sql, schema))
+
+        if mutator:
+            mutated_df = mutator(df)
+            df = mutated_df if mutated_df is not None else df
+
+        return df
+
+    Database.get_df = get_cached_df
@@ -0,0 +1,80 @@
+# Shared Redis connection pools for caches, results backend and Celery
+# -------------------------------------------------
+import threading
+from redis import BlockingConnectionPool, ConnectionPool, Redis
+from redis.sentinel import Sentinel
+
+REDIS_CLIENTS = {}
+REDIS_CLIENTS_LOCK = threading.Lock()
+
+
+def parse_nodes(nodes, default_port=6379):
+    parsed_nodes = []
+
+    for node in nodes:
+        host, _, port = node.strip().partition(":")
+        parsed_nodes.append((host, int(port) if port else default_port))
+
+    return parsed_nodes
+
+
+def create_redis_client(host, port, password, db, mode, nodes, sentinel_master, max_connections, pool_timeout,
+                        socket_timeout, socket_connect_timeout, socket_keepalive, health_check_interval):
+    connection_kwargs = {
+        "password": password,
+        "socket_timeout": socket_timeout,
+        "socket_connect_timeout": socket_connect_timeout,
+        "socket_keepalive": socket_keepalive,
+        "health_check_interval": health_check_interval
+    }
+
+    if mode == "sentinel":
+        sentinel = Sentinel(parse_nodes(nodes),
+                            socket_timeout=socket_timeout,
+                            socket_connect_timeout=socket_connect_timeout)
+
+        return sentinel.master_for(sentinel_master, db=db, max_connections=max_connections, **connection_kwargs)
+    elif mode == "cluster":
+        from redis.cluster import ClusterNode, RedisCluster
+
+        return RedisCluster(startup_nodes=[ClusterNode(*node) for node in parse_nodes(nodes)],
+                            max_connections=max_connections or 2 ** 31,
+                            **connection_kwargs)
+    elif mode == "standalone":
+        # Blocking pool makes greenlets wait for a free connection instead of failing once the pool is exhausted
+        if max_connections:
+            pool = BlockingConnectionPool(host=host, port=port, db=db, max_connections=max_connections,
+                                          timeout=pool_timeout, **connection_kwargs)
+        else:
+            pool = ConnectionPool(host=host, port=port, db=db, **connection_kwargs)
+
+        return Redis(connection_pool=pool)
+
+    raise Exception("Wrong Redis mode \"{}\"".format(mode))
+
+
+def get_redis_client(host, port=6379, password=None, db=0, mode="standalone", nodes=(), sentinel_master=None,
+                     max_connections=None, pool_timeout=20, socket_timeout=None, socket_connect_timeout=None,
+                     socket_keepalive=False, health_check_interval=0):
+    """Returns a client whose pool is shared by every caller pointing to the same Redis server and database."""
+    client_key = (host, port, password, db, mode, tuple(nodes), sentinel_master)
+
+    with REDIS_CLIENTS_LOCK:
+        if client_key not in REDIS_CLIENTS:
+            REDIS_CLIENTS[client_key] = create_redis_client(
+                host=host,
+                port=port,
+                password=password,
+                db=db,
+                mode=mode,
+                nodes=nodes,
+                sentinel_master=sentinel_master,
+                max_connections=max_connections,
+                pool_timeout=pool_timeout,
+                socket_timeout=socket_timeout,
+                socket_connect_timeout=socket_connect_timeout,
+                socket_keepalive=socket_keepalive,
+                health_check_interval=health_check_interval
+            )
+
+        return REDIS_CLIENTS[client_key]
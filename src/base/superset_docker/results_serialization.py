@@ -0,0 +1,187 @@
+# Arrow IPC / Parquet storage of SQL Lab results in the results backend
+#
+# Superset stores results as a zlib compressed msgpack payload whose "data" is a serialized Arrow table, so every read
+# decodes the whole result. ArrowResultsCache stores the table as an Arrow IPC file (or Parquet) next to msgpack
+# metadata instead and reads it from the stored buffer, materializing only the record batches (row groups) and columns
+# a request needs before handing Superset a payload in its own format.
+#
+# Reads are zero-copy only when the wrapped cache is a bare DiskCache, whose get_buffer maps the stored file. Values of
+# other caches, CompressedCache and TieredCache included, are first copied (and decompressed) into memory as a whole.
+# -------------------------------------------------
+import logging
+import struct
+import zlib
+import msgpack
+import pyarrow as pa
+import pyarrow.parquet as pq
+from cachelib import BaseCache
+from flask import g, has_request_context, request
+
+logger = logging.getLogger(__name__)
+
+SERIALIZATION_FORMATS = {"arrow": b"A", "parquet": b"P"}
+MAX_ROWS_ATTR = "results_backend_max_rows"
+COLUMNS_ATTR = "results_backend_columns"
+
+
+def select_columns(table, columns):
+    columns = [column for column in columns if column in table.schema.names]
+
+    return pa.Table.from_arrays([table.column(column) for column in columns], names=columns)
+
+
+def read_arrow(buffer, max_rows, columns):
+    reader = pa.ipc.open_file(buffer)
+    batches = []
+    rows = 0
+
+    # Record batches are views over the buffer, only the ones covering max_rows are touched
+    for idx in range(reader.num_record_batches):
+        if max_rows is not None and rows >= max_rows:
+            break
+
+        batch = reader.get_batch(idx)
+        batches.append(batch)
+        rows += batch.num_rows
+
+    table = pa.Table.from_batches(batches, schema=reader.schema)
+
+    return select_columns(table, columns) if columns else table
+
+
+def read_parquet(buffer, max_rows, columns):
+    parquet_file = pq.ParquetFile(pa.BufferReader(buffer))
+    row_groups = []
+    rows = 0
+
+    for idx in range(parquet_file.num_row_groups):
+        if max_rows is not None and rows >= max_rows:
+            break
+
+        row_groups.append(idx)
+        rows += parquet_file.metadata.row_group(idx).num_rows
+
+    return parquet_file.read_row_groups(row_groups, columns=columns, use_pandas_metadata=False)
+
+
+class ArrowResultsCache(BaseCache):
+    """Wraps a results backend, storing msgpack payloads of SQL Lab as Arrow IPC or Parquet tables."""
+
+    HEADER = b"\x00A"
+
+    def __init__(self, cache, format="arrow", batch_size=65536, parquet_compression="snappy"):
+        if format not in SERIALIZATION_FORMATS:
+            raise Exception("Wrong results serialization format \"{}\"".format(format))
+
+        super().__init__(default_timeout=cache.default_timeout)
+        self.cache = cache
+        self.format = format
+        self.batch_size = batch_size
+        self.parquet_compression = parquet_compression
+
+    def _write_table(self, table):
+        sink = pa.BufferOutputStream()
+
+        if self.format == "parquet":
+            pq.write_table(table, sink, row_group_size=self.batch_size, compression=self.parquet_compression)
+        else:
+            writer = pa.RecordBatchFileWriter(sink, table.schema)
+            writer.write_table(table, max_chunksize=self.batch_size)
+            writer.close()
+
+        return sink.getvalue().to_pybytes()
+
+    def _encode(self, value):
+        payload = msgpack.loads(zlib.decompress(value), raw=False)
+        table = pa.deserialize(payload.pop("data"))
+        metadata = msgpack.dumps(payload, use_bin_type=True)
+
+        return b"".join([self.HEADER, SERIALIZATION_FORMATS[self.format], struct.pack(">I", len(metadata)), metadata,
+                         self._write_table(table)])
+
+    def load_table(self, stored, max_rows=None, columns=None):
+        """Returns msgpack metadata and table of stored value, reading only given columns and first max_rows rows."""
+        metadata_size = struct.unpack(">I", stored[3:7])[0]
+        payload = msgpack.loads(stored[7:7 + metadata_size], raw=False)
+        buffer = pa.py_buffer(memoryview(stored)[7 + metadata_size:])
+        read = read_parquet if stored[2:3] == SERIALIZATION_FORMATS["parquet"] else read_arrow
+        table = read(buffer, max_rows, columns)
+
+        return payload, table.slice(0, max_rows) if max_rows is not None else table
+
+    def get_table(self, key):
+        """Returns msgpack metadata and Arrow table of key, None when it is missing or not stored by this cache."""
+        stored = self.cache.get_buffer(key) if hasattr(self.cache, "get_buffer") else self.cache.get(key)
+
+        if not isinstance(stored, (bytes, memoryview)) or stored[:2] != self.HEADER:
+            return None
+
+        return self.load_table(stored)
+
+    def get(self, key):
+        # Disk cache hands out its memory-mapped file, tables are then read without copying it into memory
+        stored = self.cache.get_buffer(key) if hasattr(self.cache, "get_buffer") else self.cache.get(key)
+
+        if isinstance(stored, memoryview) and stored[:2] != self.HEADER:
+            return bytes(stored)
+        elif not isinstance(stored, (bytes, memoryview)) or stored[:2] != self.HEADER:
+            return stored
+
+        max_rows, columns = None, None
+
+        if has_request_context():
+            max_rows, columns = getattr(g, MAX_ROWS_ATTR, None), getattr(g, COLUMNS_ATTR, None)
+
+        payload, table = self.load_table(stored, max_rows, columns)
+
+        if columns:
+            for columns_key in ["columns", "selected_columns"]:
+                payload[columns_key] = [column for column in payload.get(columns_key) or []
+                                        if column["name"] in table.schema.names]
+
+        payload["data"] = pa.serialize(table).to_buffer().to_pybytes()
+
+        # Superset zlib decompresses payloads, lowest level keeps the re-wrap cheap
+        return zlib.compress(msgpack.dumps(payload, use_bin_type=True), 1)
+
+    def set(self, key, value, timeout=None):
+        try:
+            value = self._encode(value)
+        except Exception:
+            # Payloads written with RESULTS_BACKEND_USE_MSGPACK disabled are JSON, they are stored as they are
+            logger.debug("Results payload %s is not an Arrow payload, storing it unchanged", key)
+
+        return self.cache.set(key, value, timeout=timeout)
+
+    def add(self, key, value, timeout=None):
+        if self.cache.has(key):
+            return False
+
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        return self.cache.delete(key)
+
+    def has(self, key):
+        return self.cache.has(key)
+
+    def clear(self):
+        return self.cache.clear()
+
+
+def init_app(app):
+    """Limits results backend reads of SQL Lab result pages to the rows (and columns) the page displays."""
+
+    def set_read_limits():
+        if request.endpoint != "Superset.results":
+            return
+
+        try:
+            setattr(g, MAX_ROWS_ATTR, int(request.args["rows"]) if "rows" in request.args else None)
+        except ValueError:
+            pass
+
+        if request.args.get("columns"):
+            setattr(g, COLUMNS_ATTR, request.args["columns"].split(","))
+
+    app.before_request(set_read_limits)
@@ -0,0 +1,257 @@
+# Pooled headless browsers for thumbnails and email reports, re-renders skipped for unchanged charts and dashboards
+#
+# Superset starts and quits a webdriver for every render. Here drivers are borrowed from a per-process pool of warm
+# browsers instead, renders wait in a bounded queue and browsers are recycled after a number of renders or when their
+# process tree grows beyond a memory limit.
+# -------------------------------------------------
+import logging
+import threading
+from collections import deque
+from io import BytesIO
+from time import time
+import psutil
+
+logger = logging.getLogger(__name__)
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+RENDERED_AT_KEY = "{}:rendered_at"
+
+
+def get_browser_memory(driver):
+    """Returns RSS of webdriver process and its children (the browser itself) in bytes."""
+    try:
+        process = psutil.Process(driver.service.process.pid)
+
+        return sum(child.memory_info().rss for child in [process] + process.children(recursive=True))
+    except (AttributeError, psutil.Error):
+        return 0
+
+
+class BrowserPool:
+    def __init__(self, name, create, destroy, size, max_waiting, acquire_timeout, max_renders, max_memory,
+                 render_timeout, reset=None):
+        self.name = name
+        self.create = create
+        self.destroy = destroy
+        self.size = size
+        self.max_waiting = max_waiting
+        self.acquire_timeout = acquire_timeout
+        self.max_renders = max_renders
+        self.max_memory = max_memory
+        self.render_timeout = render_timeout
+        self.reset = reset
+        self.idle = deque()
+        self.renders = {}
+        self.waiting = 0
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def owns(self, driver):
+        return id(driver) in self.renders
+
+    def new_driver(self):
+        driver = self.create()
+
+        if self.render_timeout:
+            driver.set_page_load_timeout(self.render_timeout)
+            driver.set_script_timeout(self.render_timeout)
+
+        self.renders[id(driver)] = 0
+
+        return driver
+
+    def prewarm(self):
+        with self.lock:
+            missing = self.size - len(self.idle)
+
+        for _ in range(missing):
+            driver = self.new_driver()
+
+            with self.lock:
+                self.idle.append(driver)
+
+    def acquire(self):
+        with self.lock:
+            if self.waiting >= self.max_waiting:
+                raise Exception("Render queue of browser pool \"{}\" is full ({} renders waiting)".format(
+                    self.name, self.waiting
+                ))
+
+            self.waiting += 1
+
+        try:
+            if not self.slots.acquire(timeout=self.acquire_timeout):
+                raise Exception("No browser of pool \"{}\" became available in {} seconds".format(
+                    self.name, self.acquire_timeout
+                ))
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+        try:
+            with self.lock:
+                driver = self.idle.popleft() if self.idle else None
+
+            return driver or self.new_driver()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def retire(self, driver):
+        self.renders.pop(id(driver), None)
+
+        try:
+            self.destroy(driver)
+        except Exception:
+            logger.exception("Browser of pool \"%s\" could not be quit", self.name)
+
+    def release(self, driver):
+        try:
+            self.renders[id(driver)] += 1
+            memory = get_browser_memory(driver)
+
+            if self.renders[id(driver)] >= self.max_renders or (self.max_memory and memory > self.max_memory):
+                logger.info("Recycling browser of pool \"%s\" after %s renders using %s bytes",
+                            self.name, self.renders[id(driver)], memory)
+                self.retire(driver)
+                return
+
+            try:
+                if self.reset:
+                    self.reset(driver)
+            except Exception:
+                # Browser crashed or hung, start a fresh one on next acquire
+                logger.exception("Browser of pool \"%s\" could not be reset", self.name)
+                self.retire(driver)
+                return
+
+            with self.lock:
+                self.idle.append(driver)
+        finally:
+            self.slots.release()
+
+
+def reset_browser(driver):
+    driver.delete_all_cookies()
+    driver.get("about:blank")
+
+
+def optimize_png(image):
+    from PIL import Image
+
+    optimized_image = BytesIO()
+    Image.open(BytesIO(image)).save(optimized_image, format="png", optimize=True)
+    optimized_image = optimized_image.getvalue()
+
+    return optimized_image if len(optimized_image) < len(image) else image
+
+
+class ThumbnailCache:
+    """Proxy of thumbnail cache storing size optimized PNGs along with the time they are rendered."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def set(self, key, value, *args, **kwargs):
+        if isinstance(value, bytes) and value.startswith(PNG_SIGNATURE):
+            try:
+                value = optimize_png(value)
+            except Exception:
+                logger.exception("Thumbnail %s could not be optimized", key)
+
+        self.cache.set(RENDERED_AT_KEY.format(key), time(), *args, **kwargs)
+
+        return self.cache.set(key, value, *args, **kwargs)
+
+
+def install(app, pool_options, rerender_interval):
+    """Makes Superset webdriver users borrow browsers from pools and skip re-rendering of unchanged thumbnails.
+
+    Cache keys of thumbnails are digests of chart or dashboard definitions, so a forced render whose key already has
+    an image rendered less than rerender_interval seconds ago is answered from cache.
+    """
+    from superset.tasks import schedules
+    from superset.utils.screenshots import BaseScreenshot, WebDriverProxy
+
+    pools = {}
+    create_webdriver = WebDriverProxy.create
+    destroy_webdriver = WebDriverProxy.destroy
+    create_report_webdriver = schedules.create_webdriver
+    destroy_report_webdriver = schedules.destroy_webdriver
+    compute_and_cache = BaseScreenshot.compute_and_cache
+
+    def get_pool(name, create, destroy, reset):
+        if name not in pools:
+            pools[name] = BrowserPool(name, create, destroy, reset=reset, **pool_options)
+
+        return pools[name]
+
+    def get_thumbnail_pool(driver_type):
+        return get_pool("thumbnails-{}".format(driver_type),
+                        lambda: create_webdriver(WebDriverProxy(driver_type)),
+                        destroy_webdriver,
+                        reset_browser)
+
+    def get_report_pool():
+        # Report browsers are logged in as EMAIL_REPORTS_USER once and keep their session cookie between renders
+        return get_pool("reports", create_report_webdriver, destroy_report_webdriver, None)
+
+    def create_pooled_webdriver(self):
+        driver = get_thumbnail_pool(self._driver_type).acquire()
+        driver.set_window_size(*self._window)
+
+        return driver
+
+    def destroy_pooled_webdriver(driver, *args, **kwargs):
+        for pool in list(pools.values()):
+            if pool.owns(driver):
+                return pool.release(driver)
+
+        return destroy_webdriver(driver, *args, **kwargs)
+
+    def create_pooled_report_webdriver(*args, **kwargs):
+        return get_report_pool().acquire()
+
+    def destroy_pooled_report_webdriver(driver, *args, **kwargs):
+        pool = get_report_pool()
+
+        if pool.owns(driver):
+            return pool.release(driver)
+
+        return destroy_report_webdriver(driver, *args, **kwargs)
+
+    def compute_and_cache_unchanged(self, *args, **kwargs):
+        cache = kwargs.get("cache")
+
+        if cache is None:
+            return compute_and_cache(self, *args, **kwargs)
+
+        cache_key = self.cache_key(kwargs.get("window_size"), kwargs.get("thumb_size"))
+        rendered_at = cache.get(RENDERED_AT_KEY.format(cache_key))
+
+        if kwargs.get("force", True) and rendered_at and time() - rendered_at < rerender_interval and \
+                cache.get(cache_key):
+            logger.info("Thumbnail %s is unchanged since %s, skipping render", cache_key, rendered_at)
+            kwargs["force"] = False
+
+        kwargs["cache"] = ThumbnailCache(cache)
+
+        return compute_and_cache(self, *args, **kwargs)
+
+    WebDriverProxy.create = create_pooled_webdriver
+    WebDriverProxy.destroy = staticmethod(destroy_pooled_webdriver)
+    schedules.create_webdriver = create_pooled_report_webdriver
+    schedules.destroy_webdriver = destroy_pooled_report_webdriver
+    BaseScreenshot.compute_and_cache = compute_and_cache_unchanged
+
+    def prewarm(**kwargs):
+        with app.app_context():
+            try:
+                get_thumbnail_pool(app.config["WEBDRIVER_TYPE"]).prewarm()
+            except Exception:
+                logger.exception("Browser pool could not be prewarmed")
+
+    return prewarm
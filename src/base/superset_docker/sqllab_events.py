@@ -0,0 +1,235 @@
+# SQL Lab query state changes pushed over Redis pub/sub instead of browsers polling the metadata database
+#
+# Every process (webserver and Celery workers) publishes committed changes of Query rows to a per-user channel and
+# records them in a per-user Redis hash. Webservers stream them to browsers over Server-Sent Events through a single
+# pattern subscription per process. Polls of /superset/queries/<last_updated_ms>, kept as fallback for clients not
+# using the stream, are answered from the hash without touching the metadata database.
+# -------------------------------------------------
+import json
+import logging
+import queue
+import threading
+from collections import defaultdict
+from datetime import datetime
+from time import monotonic
+from flask import Blueprint, Response, g, request, stream_with_context
+from flask_login import current_user
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "{}:channel:{}"
+QUERIES_KEY = "{}:queries:{}"
+SINCE_KEY = "{}:since:{}"
+WORKERS_KEY = "{}:workers"
+
+
+class QueryEventPublisher:
+    """Records and publishes serialized Query rows, keyed by user."""
+
+    def __init__(self, client, key_prefix, retention, resync_interval):
+        self.client = client
+        self.key_prefix = key_prefix
+        self.retention = retention
+        self.resync_interval = resync_interval
+
+    def publish(self, user_id, client_id, changed_on_ms, payload):
+        queries_key = QUERIES_KEY.format(self.key_prefix, user_id)
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.hset(queries_key, client_id, "{}|{}".format(changed_on_ms, payload))
+        pipeline.expire(queries_key, self.retention)
+        # Marker expires regardless of activity so pollers fall back to the metadata database once per interval,
+        # healing changes whose publish was lost with a crashed process
+        pipeline.set(SINCE_KEY.format(self.key_prefix, user_id), changed_on_ms, nx=True, ex=self.resync_interval)
+        pipeline.publish(CHANNEL.format(self.key_prefix, user_id), json.dumps({"client_id": client_id,
+                                                                             "changed_on": changed_on_ms,
+                                                                             "query": json.loads(payload)}))
+        pipeline.execute()
+
+    def mark_workers_active(self, ttl):
+        """Called by Celery workers publishing their Query changes, polls are answered from Redis only meanwhile."""
+        self.client.set(WORKERS_KEY.format(self.key_prefix), 1, ex=ttl)
+
+    def get_changes(self, user_id, last_updated_ms):
+        """Returns JSON of queries changed since last_updated_ms, None when Redis does not hold all of them."""
+        workers_active, since, queries = self.client.pipeline(transaction=False) \
+                                                    .exists(WORKERS_KEY.format(self.key_prefix)) \
+                                                    .get(SINCE_KEY.format(self.key_prefix, user_id)) \
+                                                    .hgetall(QUERIES_KEY.format(self.key_prefix, user_id)) \
+                                                    .execute()
+
+        # Async query states are changed by workers, without them publishing the hash misses those changes
+        if not workers_active or since is None or last_updated_ms < int(since):
+            return None
+
+        changes = []
+
+        for client_id, value in queries.items():
+            changed_on_ms, payload = value.decode("utf-8").split("|", 1)
+
+            if int(changed_on_ms) >= last_updated_ms:
+                changes.append("{}:{}".format(json.dumps(client_id.decode("utf-8")), payload))
+
+        return "{" + ",".join(changes) + "}"
+
+
+class EventHub(threading.Thread):
+    """Single pattern subscription per process, fanning messages out to the streams of subscribed users."""
+
+    def __init__(self, client, key_prefix):
+        super().__init__(daemon=True)
+        self.client = client
+        self.key_prefix = key_prefix
+        self.subscribers = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        subscriber = queue.Queue(maxsize=1000)
+
+        with self.lock:
+            self.subscribers[str(user_id)].add(subscriber)
+
+        return subscriber
+
+    def unsubscribe(self, user_id, subscriber):
+        with self.lock:
+            self.subscribers[str(user_id)].discard(subscriber)
+
+            if not self.subscribers[str(user_id)]:
+                del self.subscribers[str(user_id)]
+
+    def dispatch(self, message):
+        user_id = message["channel"].decode("utf-8").rsplit(":", 1)[1]
+
+        with self.lock:
+            subscribers = list(self.subscribers.get(user_id, ()))
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message["data"])
+            except queue.Full:
+                # A stalled browser must not block others, it catches up through the polling fallback
+                pass
+
+    def run(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(CHANNEL.format(self.key_prefix, "*"))
+
+                for message in pubsub.listen():
+                    if message["type"] == "pmessage":
+                        self.dispatch(message)
+            except Exception:
+                logger.exception("SQL Lab event subscription failed, resubscribing")
+                threading.Event().wait(1)
+
+
+def install(app, publisher, subscriber_client, stream_timeout, heartbeat_interval):
+    """Publishes Query changes of this process, registers the event stream and answers polls from Redis."""
+    from celery.signals import heartbeat_sent, worker_ready
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+    from superset.models.sql_lab import Query
+    from superset.utils.core import datetime_to_epoch, json_int_dttm_ser
+
+    hub = EventHub(subscriber_client, publisher.key_prefix)
+    hub_started = []
+    hub_lock = threading.Lock()
+
+    def collect_changes(session, flush_context):
+        changes = session.info.setdefault("sqllab_events", {})
+
+        for instance in list(session.new) + list(session.dirty):
+            if isinstance(instance, Query) and instance.user_id is not None:
+                changes[instance.client_id] = (
+                    instance.user_id,
+                    int(datetime_to_epoch(instance.changed_on or datetime.utcnow())),
+                    json.dumps(instance.to_dict(), default=json_int_dttm_ser)
+                )
+
+    def publish_changes(session):
+        for client_id, (user_id, changed_on_ms, payload) in session.info.pop("sqllab_events", {}).items():
+            try:
+                publisher.publish(user_id, client_id, changed_on_ms, payload)
+            except Exception:
+                logger.exception("SQL Lab event of query %s could not be published", client_id)
+
+    def discard_changes(session):
+        session.info.pop("sqllab_events", None)
+
+    # Listening on Session class covers Flask-SQLAlchemy session and the plain sessions of sql_lab.session_scope
+    # workers update Query rows with. Changes are serialized after flush, when changed_on is set, and published only
+    # once committed
+    event.listen(Session, "after_flush", collect_changes)
+    event.listen(Session, "after_commit", publish_changes)
+    event.listen(Session, "after_rollback", discard_changes)
+
+    workers_marked_at = [0.0]
+
+    def mark_workers_active(**kwargs):
+        # Worker heartbeats (-E) come every 2 seconds, the marker outlives a few missed ones
+        if monotonic() - workers_marked_at[0] < 10:
+            return
+
+        try:
+            publisher.mark_workers_active(ttl=60)
+            workers_marked_at[0] = monotonic()
+        except Exception:
+            logger.exception("SQL Lab event publishing of worker could not be announced")
+
+    worker_ready.connect(mark_workers_active, weak=False)
+    heartbeat_sent.connect(mark_workers_active, weak=False)
+
+    def answer_poll_from_redis():
+        # Runs before the view and its permission check, served changes are only ever the user's own queries
+        if request.endpoint != "Superset.queries" or not current_user.is_authenticated:
+            return None
+
+        try:
+            changes = publisher.get_changes(current_user.get_id(), int(float(request.view_args["last_updated_ms"])))
+        except Exception:
+            logger.exception("Polling SQL Lab queries from Redis failed, falling back to metadata database")
+            return None
+
+        return Response(changes, mimetype="application/json") if changes is not None else None
+
+    app.before_request(answer_poll_from_redis)
+
+    blueprint = Blueprint("sqllab_events", __name__)
+
+    @blueprint.route("/sqllab/events/")
+    def stream_events():
+        if not g.user or not g.user.is_authenticated:
+            return Response("Please login to access the queries.", status=403)
+
+        with hub_lock:
+            if not hub_started:
+                hub.start()
+                hub_started.append(True)
+
+        user_id = g.user.get_id()
+        subscriber = hub.subscribe(user_id)
+
+        def generate():
+            deadline = monotonic() + stream_timeout
+
+            try:
+                # Browsers reconnect by themselves when a stream ends, so streams are recycled periodically
+                yield "retry: 3000\n\n"
+
+                while monotonic() < deadline:
+                    try:
+                        yield "event: query\ndata: {}\n\n".format(subscriber.get(timeout=heartbeat_interval)
+                                                                  .decode("utf-8"))
+                    except queue.Empty:
+                        yield ": heartbeat\n\n"
+            finally:
+                hub.unsubscribe(user_id, subscriber)
+
+        response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+
+        return response
+
+    app.register_blueprint(blueprint)
@@ -0,0 +1,158 @@
+# Prometheus instrumentation: stats logger, request latency, cache and results backend metrics
+#
+# Metrics of gunicorn workers and Celery children are aggregated through prometheus_client multiprocess mode when
+# PROMETHEUS_MULTIPROC_DIR is set (entrypoint.sh sets it up when STATS_LOGGER_TYPE is prometheus).
+# -------------------------------------------------
+from os import environ
+from time import monotonic
+from cachelib import BaseCache
+from flask import Response, g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY,
+                               generate_latest, multiprocess)
+from superset.stats_logger import BaseStatsLogger
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+PAYLOAD_SIZE_BUCKETS = tuple(2 ** power for power in range(8, 31, 2))
+
+EVENTS = Counter("superset_events_total", "Superset stats logger counters", ["key"])
+# Counters cannot go down, decrements are counted apart
+DECREMENTED_EVENTS = Counter("superset_events_decremented_total", "Superset stats logger counter decrements", ["key"])
+TIMINGS = Histogram("superset_timing_milliseconds", "Superset stats logger timings", ["key"],
+                    buckets=tuple(bucket * 1000 for bucket in LATENCY_BUCKETS))
+GAUGES = Gauge("superset_gauge", "Superset stats logger gauges", ["key"], multiprocess_mode="livesum")
+REQUEST_LATENCY = Histogram("superset_http_request_duration_seconds", "Webserver request latency",
+                            ["endpoint", "method", "status"], buckets=LATENCY_BUCKETS)
+CACHE_REQUESTS = Counter("superset_cache_requests_total", "Cache lookups", ["cache", "result"])
+CACHE_LATENCY = Histogram("superset_cache_operation_duration_seconds", "Cache round-trip time",
+                          ["cache", "operation"], buckets=LATENCY_BUCKETS)
+CACHE_PAYLOAD_SIZE = Histogram("superset_cache_payload_bytes", "Cache payload sizes", ["cache", "operation"],
+                               buckets=PAYLOAD_SIZE_BUCKETS)
+
+
+class PrometheusStatsLogger(BaseStatsLogger):
+    def incr(self, key):
+        EVENTS.labels(key=self.prefix + key).inc()
+
+    def decr(self, key):
+        DECREMENTED_EVENTS.labels(key=self.prefix + key).inc()
+
+    def timing(self, key, value):
+        TIMINGS.labels(key=self.prefix + key).observe(value)
+
+    def gauge(self, key, value=1):
+        GAUGES.labels(key=self.prefix + key).set(value)
+
+
+class InstrumentedCache(BaseCache):
+    """Wraps a cache, recording hits, misses, payload sizes and round-trip times labelled with cache name."""
+
+    def __init__(self, cache, name):
+        super().__init__(default_timeout=cache.default_timeout)
+        self.cache = cache
+        self.name = name
+
+    def _call(self, operation, function, *args, **kwargs):
+        started = monotonic()
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            CACHE_LATENCY.labels(cache=self.name, operation=operation).observe(monotonic() - started)
+
+    def _observe_payload(self, operation, value):
+        # Sizing other values would pickle them once more on every call, only serialized payloads are observed
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            CACHE_PAYLOAD_SIZE.labels(cache=self.name, operation=operation).observe(len(value))
+
+    def get(self, key):
+        value = self._call("get", self.cache.get, key)
+
+        CACHE_REQUESTS.labels(cache=self.name, result="miss" if value is None else "hit").inc()
+
+        if value is not None:
+            self._observe_payload("get", value)
+
+        return value
+
+    def get_many(self, *keys):
+        values = self._call("get_many", self.cache.get_many, *keys)
+        hits = sum(1 for value in values if value is not None)
+
+        CACHE_REQUESTS.labels(cache=self.name, result="hit").inc(hits)
+        CACHE_REQUESTS.labels(cache=self.name, result="miss").inc(len(values) - hits)
+
+        return values
+
+    def set(self, key, value, timeout=None):
+        self._observe_payload("set", value)
+
+        return self._call("set", self.cache.set, key, value, timeout=timeout)
+
+    def add(self, key, value, timeout=None):
+        self._observe_payload("add", value)
+
+        return self._call("add", self.cache.add, key, value, timeout=timeout)
+
+    def set_many(self, mapping, timeout=None):
+        return self._call("set_many", self.cache.set_many, mapping, timeout=timeout)
+
+    def delete(self, key):
+        return self._call("delete", self.cache.delete, key)
+
+    def delete_many(self, *keys):
+        return self._call("delete_many", self.cache.delete_many, *keys)
+
+    def has(self, key):
+        return self._call("has", self.cache.has, key)
+
+    def clear(self):
+        return self._call("clear", self.cache.clear)
+
+    def inc(self, key, delta=1):
+        return self._call("inc", self.cache.inc, key, delta=delta)
+
+    def dec(self, key, delta=1):
+        return self._call("dec", self.cache.dec, key, delta=delta)
+
+
+def instrumented_cache(app, config, args, kwargs):
+    """Flask-Caching factory (CACHE_TYPE) building CACHE_INSTRUMENTED_TYPE cache wrapped with InstrumentedCache."""
+    from flask_caching import backends
+    from werkzeug.utils import import_string
+
+    cache_type = config["CACHE_INSTRUMENTED_TYPE"]
+    factory = import_string(cache_type) if "." in cache_type else getattr(backends, cache_type)
+
+    return InstrumentedCache(factory(app, config, args, kwargs), config["CACHE_INSTRUMENTED_NAME"])
+
+
+def get_metrics():
+    if environ.get("PROMETHEUS_MULTIPROC_DIR") or environ.get("prometheus_multiproc_dir"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app, metrics_path="/metrics"):
+    def start_timer():
+        g.request_started = monotonic()
+
+    def record_status(response):
+        g.response_status = response.status_code
+
+        return response
+
+    def record_request_latency(exc):
+        # Teardown also runs for requests whose exception escaped, after_request does not see those
+        if hasattr(g, "request_started"):
+            REQUEST_LATENCY.labels(endpoint=request.endpoint or "unknown",
+                                   method=request.method,
+                                   status=g.get("response_status", 500)).observe(monotonic() - g.request_started)
+
+    app.before_request(start_timer)
+    app.after_request(record_status)
+    app.teardown_request(record_request_latency)
+    app.add_url_rule(metrics_path, "prometheus_metrics", get_metrics)
@@ -0,0 +1,240 @@
+# Table names prefetch: keeps SQL Lab table lists warm and maintains an indexed table/column snapshot per database
+#
+# Every run lists schemas and tables of configured databases with force=True, which refreshes the very cache entries
+# SQL Lab reads (TABLE_NAMES_CACHE_CONFIG), so no user waits for a metadata scan. Table lists are fingerprinted and
+# column metadata, the expensive part, is fetched only for tables of changed schemas and for entries older than
+# columns_max_age.
+# -------------------------------------------------
+import hashlib
+import logging
+from bisect import bisect_left
+from time import time
+from flask import Blueprint, g, jsonify, request
+from superset import db, security_manager, tables_cache
+from superset.extensions import celery_app
+from superset.models.core import Database
+from superset.utils.core import DatasourceName
+
+logger = logging.getLogger(__name__)
+
+# Database entry lists schemas, schema entries index their tables and column lists are stored per table, so search
+# loads the small indexes only and the columns of the tables it returns. Schema and table names are hashed into keys
+SNAPSHOT_KEY = "table_metadata:snapshot:{}"
+SCHEMA_KEY = "table_metadata:schema:{}:{}"
+COLUMNS_KEY = "table_metadata:columns:{}:{}"
+
+
+def get_digest(*names):
+    return hashlib.sha1("\n".join(names).encode("utf-8")).hexdigest()
+
+
+def get_schema_key(database_id, schema):
+    return SCHEMA_KEY.format(database_id, get_digest(schema))
+
+
+def get_columns_key(database_id, schema, table):
+    return COLUMNS_KEY.format(database_id, get_digest(schema, table))
+
+
+def get_fingerprint(table_names):
+    return get_digest(*sorted(table_names))
+
+
+def build_index(table_names):
+    """Returns sorted (search key, table) entries of schema tables, keyed by table name in lower case."""
+    return sorted((table.lower(), table) for table in table_names)
+
+
+def iter_index_matches(schema, index, prefix):
+    """Yields tables of schema index whose "table" or "schema.table" (in lower case) starts with prefix."""
+    qualifier = "{}.".format(schema).lower()
+
+    # Prefix of the qualifier itself matches every table of the schema
+    if qualifier.startswith(prefix):
+        yield from (table for _, table in index)
+        return
+
+    for table_prefix in ([prefix[len(qualifier):]] if prefix.startswith(qualifier) else []) + [prefix]:
+        for idx in range(bisect_left(index, (table_prefix,)), len(index)):
+            key, table = index[idx]
+
+            if not key.startswith(table_prefix):
+                break
+
+            yield table
+
+
+def search(indexes, prefix, is_accessible=None, limit=100):
+    """Returns (schema, table) of indexes, given as {schema: index}, matching prefix ordered by table name."""
+    prefix = prefix.lower()
+    matches = set()
+
+    for schema, index in indexes.items():
+        schema_matches = set()
+
+        for table in iter_index_matches(schema, index, prefix):
+            if len(schema_matches) >= limit:
+                break
+            elif is_accessible is None or is_accessible(schema, table):
+                schema_matches.add((schema, table))
+
+        matches.update(schema_matches)
+
+    return sorted(matches, key=lambda match: (match[1].lower(), match[0]))[:limit]
+
+
+def get_columns(database, schema, table):
+    try:
+        return [{"name": column["name"], "type": str(column["type"])}
+                for column in database.get_columns(table, schema=schema)]
+    except Exception:
+        logger.exception("Columns of %s.%s in database %s could not be fetched", schema, table, database.id)
+        return None
+
+
+def store(key, value):
+    # Caches fail silently on values they cannot hold (e.g. beyond memcached item size)
+    if not tables_cache.set(key, value, timeout=0):
+        logger.error("Table metadata %s could not be stored in tables cache", key)
+
+
+def delete_columns(database, schema, tables):
+    # Redis DEL without keys is an error
+    if tables:
+        tables_cache.delete_many(*[get_columns_key(database.id, schema, table) for table in tables])
+
+
+def delete_schema(database, schema, schema_entry):
+    delete_columns(database, schema, [table for _, table in schema_entry["index"]])
+    tables_cache.delete(get_schema_key(database.id, schema))
+
+
+def refresh_schema(database, schema, cache_timeout, columns_max_age, max_column_refreshes, now):
+    """Refreshes index and stale column lists of schema, returns whether its tables changed and columns refreshed."""
+    table_names = [datasource_name.table for datasource_name in
+                   database.get_all_table_names_in_schema(schema=schema, cache=True, cache_timeout=cache_timeout,
+                                                          force=True) +
+                   database.get_all_view_names_in_schema(schema=schema, cache=True, cache_timeout=cache_timeout,
+                                                         force=True)]
+    fingerprint = get_fingerprint(table_names)
+    schema_entry = tables_cache.get(get_schema_key(database.id, schema))
+    changed = schema_entry is None or schema_entry["fingerprint"] != fingerprint
+
+    if changed:
+        if schema_entry is not None:
+            delete_columns(database, schema, list({table for _, table in schema_entry["index"]} - set(table_names)))
+
+        store(get_schema_key(database.id, schema), {"fingerprint": fingerprint, "index": build_index(table_names)})
+
+    column_entries = tables_cache.get_many(*[get_columns_key(database.id, schema, table) for table in table_names]) \
+        if table_names else []
+
+    # New tables have never been refreshed so they come first, then the stalest ones
+    stale_tables = sorted((column_entry["refreshed_at"] if column_entry else 0, table)
+                          for table, column_entry in zip(table_names, column_entries)
+                          if not column_entry or now - column_entry["refreshed_at"] >= columns_max_age)
+    column_refreshes = 0
+
+    for _, table in stale_tables[:max_column_refreshes]:
+        columns = get_columns(database, schema, table)
+        column_refreshes += 1
+
+        if columns is not None:
+            store(get_columns_key(database.id, schema, table), {"columns": columns, "refreshed_at": now})
+
+    return changed, column_refreshes
+
+
+def refresh_database(database, schemas, cache_timeout, columns_max_age, max_column_refreshes):
+    snapshot = tables_cache.get(SNAPSHOT_KEY.format(database.id)) or {"schemas": []}
+    schemas = schemas or database.get_all_schema_names(cache=True, cache_timeout=cache_timeout, force=True)
+    now = time()
+    column_refreshes = 0
+    changed_schemas = []
+
+    for schema in schemas:
+        changed, schema_column_refreshes = refresh_schema(database, schema, cache_timeout, columns_max_age,
+                                                          max_column_refreshes - column_refreshes, now)
+        column_refreshes += schema_column_refreshes
+
+        if changed:
+            changed_schemas.append(schema)
+
+    for schema in set(snapshot["schemas"]) - set(schemas):
+        schema_entry = tables_cache.get(get_schema_key(database.id, schema))
+
+        if schema_entry is not None:
+            delete_schema(database, schema, schema_entry)
+
+        changed_schemas.append(schema)
+
+    store(SNAPSHOT_KEY.format(database.id), {"schemas": sorted(schemas), "refreshed_at": now})
+
+    return {"changed_schemas": changed_schemas, "column_refreshes": column_refreshes}
+
+
+@celery_app.task(name="table-names-prefetch", soft_time_limit=3600)
+def prefetch_table_names(databases, cache_timeout=3600, columns_max_age=86400, max_column_refreshes=500):
+    """Refreshes table metadata of databases, given as {database name: [schemas, all schemas when empty]}."""
+    report = {}
+
+    for database in db.session.query(Database).filter(Database.database_name.in_(list(databases))).all():
+        try:
+            report[database.database_name] = refresh_database(database,
+                                                              databases[database.database_name],
+                                                              cache_timeout,
+                                                              columns_max_age,
+                                                              max_column_refreshes)
+        except Exception:
+            logger.exception("Table names of database %s could not be prefetched", database.database_name)
+
+    logger.info("Prefetched table names: %s", report)
+
+    return report
+
+
+blueprint = Blueprint("table_metadata", __name__)
+
+
+@blueprint.route("/table_metadata/<int:database_id>/search/")
+def search_view(database_id):
+    """Prefix search over prefetched table names, limited to the tables user can access."""
+    if not g.user or not g.user.is_authenticated:
+        return jsonify({"message": "Not authenticated"}), 401
+
+    database = db.session.query(Database).get(database_id)
+    snapshot = tables_cache.get(SNAPSHOT_KEY.format(database_id)) if database else None
+
+    if snapshot is None:
+        return jsonify({"message": "No prefetched table names for database {}".format(database_id)}), 404
+
+    schemas = security_manager.get_schemas_accessible_by_user(database, snapshot["schemas"])
+    schema_entries = tables_cache.get_many(*[get_schema_key(database_id, schema) for schema in schemas]) \
+        if schemas else []
+    indexes = {schema: schema_entry["index"] for schema, schema_entry in zip(schemas, schema_entries) if schema_entry}
+    accessible_tables = {}
+
+    def is_accessible(schema, table):
+        # Schemas are also listed for datasource access to any of their tables, so tables are checked the way SQL
+        # Lab table lists are, once per schema met by the search
+        if schema not in accessible_tables:
+            datasource_names = [DatasourceName(table=name, schema=schema) for _, name in indexes[schema]]
+            accessible_tables[schema] = {datasource_name.table for datasource_name in
+                                         security_manager.get_datasources_accessible_by_user(database,
+                                                                                             datasource_names,
+                                                                                             schema=schema)}
+
+        return table in accessible_tables[schema]
+
+    matches = search(indexes,
+                     request.args.get("q", ""),
+                     is_accessible=is_accessible,
+                     limit=min(request.args.get("limit", 100, type=int), 1000))
+    column_entries = tables_cache.get_many(*[get_columns_key(database_id, schema, table)
+                                             for schema, table in matches]) if matches else []
+
+    return jsonify({
+        "result": [{"schema": schema, "table": table, "columns": column_entry["columns"] if column_entry else []}
+                   for (schema, table), column_entry in zip(matches, column_entries)],
+        "refreshed_at": snapshot["refreshed_at"]
+    })